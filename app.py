@@ -1,24 +1,34 @@
 # -*- coding: utf-8 -*-
-import sys
+import io
 import json
+import time
+import functools
 
 import dash
+import flask
 from dash import dcc
 from dash import html
 import plotly.graph_objs as go
+import plotly.utils
 from plotly.colors import DEFAULT_PLOTLY_COLORS as COLORS
-import pycountry
-import datetime
 import urllib.parse 
 
+import numpy as np
 import pandas as pd
-import pycountry
 try:
     from data.SECRET  import mapbox_access_token 
 except: 
     mapbox_access_token="foo"
 
+import periods
 import rainproc as rp
+from catalog import StationCatalog
+from stationmap import StationClusters, viewport
+from spatial import StationIndex
+from downsample import view_indices
+from cache import LRUCache, frame_nbytes
+from metrics import REGISTRY, BYTES, stage, cache_counters
+from compute import SingleFlight, BoundedPool, Overloaded
 
 BUTTONSTOREMOVE=['zoomIn2d', 'zoomOut2d', 'sendDataToCloud','hoverCompareCartesian', 
                  'sendDataToCloud', 'autoScale2d', 'hoverClosestCartesian', 'hoverCompareCartesian', 
@@ -26,6 +36,31 @@ BUTTONSTOREMOVE=['zoomIn2d', 'zoomOut2d', 'sendDataToCloud','hoverCompareCartesi
 
 CONFIG={'modeBarButtonsToRemove': BUTTONSTOREMOVE, 'displaylogo': False,} 
 
+MAXSTATIONS = 3 # compared at once, the last ones selected
+MAXPOINTS = 2000 # per series sent to the chart, longer (daily) series are min-max downsampled
+CSVCHUNK = 1000 # rows per chunk of a streamed csv download
+RESULTS_MAXBYTES = 32*1024**2 # computed selections kept per process, see station_result
+results = LRUCache(RESULTS_MAXBYTES, sizeof=lambda res: sum(frame_nbytes(d) for d in res['series']))
+TREND_ALPHA = .05 # p-value below which the map shows a station's trend as significant
+SLOW_SELECTION = 1.0 # seconds; selections computed slower are counted per station and frequency
+COMPUTE_WORKERS = 4 # threads per process computing selections, see station_result
+COMPUTE_QUEUE = 16 # selections that may wait for one of them before requests are refused (503)
+COMPUTE_TIMEOUT = 30 # seconds a request waits for its selection before it is refused
+selection_flights = SingleFlight()
+compute_pool = BoundedPool(COMPUTE_WORKERS, COMPUTE_QUEUE, COMPUTE_TIMEOUT)
+
+REGISTRY.add_collector(cache_counters('results', results))
+REGISTRY.histogram('rainfall_callback_seconds', 'Latency of Dash callback requests, by output')
+REGISTRY.histogram('rainfall_callback_response_bytes', 'Size of Dash callback responses, by output', BYTES)
+REGISTRY.histogram('rainfall_selection_seconds', 'Time to compute a selection (read, resample, fit, stats)')
+REGISTRY.counter('rainfall_slow_selections_total', 'Selections that took longer than SLOW_SELECTION to compute')
+REGISTRY.counter('rainfall_coalesced_total', 'Computations a request shared with an identical one in flight')
+REGISTRY.counter('rainfall_overloaded_total', 'Requests refused because the compute queue was full')
+REGISTRY.add_collector(lambda: [
+    ('rainfall_coalesced_total', dict(computation='selection'), selection_flights.info()['shared']),
+    ('rainfall_coalesced_total', dict(computation='resampled'), rp.resample_flights.info()['shared']),
+    ('rainfall_overloaded_total', {}, compute_pool.refused)])
+
 # load the styles
 external_css = [
     "https://cdnjs.cloudflare.com/ajax/libs/skeleton/2.0.4/skeleton.min.css",
@@ -38,43 +73,121 @@ external_css = [
 app = dash.Dash('Rainfall trends in and around Europe', external_stylesheets=external_css)
 server = app.server
 
-# function below sets the color based on amount
+@server.before_request
+def _start_timer():
+    flask.g.started = time.perf_counter()
+    flask.g.callback_seconds = 0.
+
+@server.after_request
+def _record_request(response):
+    """Latency and payload size of callback requests; the part not spent in the callback
+    itself (see timed) is mostly Dash serializing the response."""
+    if flask.request.path.endswith('/_dash-update-component'):
+        elapsed = time.perf_counter()-flask.g.started
+        output = (flask.request.get_json(silent=True) or {}).get('output', '')
+        REGISTRY.observe('rainfall_callback_seconds', elapsed, callback=output)
+        REGISTRY.observe('rainfall_callback_response_bytes', response.content_length or 0, callback=output)
+        REGISTRY.observe('rainfall_stage_seconds', elapsed-flask.g.callback_seconds, stage='serialize', freq='')
+    REGISTRY.dump()
+    return response
+
+@server.errorhandler(Overloaded)
+def overloaded(e):
+    """Refuse, rather than queue, work beyond COMPUTE_QUEUE; the browser keeps its current view"""
+    return flask.Response('Too many requests are being computed, try again shortly.', 503, {'Retry-After': '5'})
+
+@server.route('/metrics')
+def metrics():
+    """Prometheus metrics of all worker processes"""
+    return flask.Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+def timed(callback):
+    """Record the time spent in a callback's body, for _record_request"""
+    @functools.wraps(callback)
+    def wrapper(*args):
+        t = time.perf_counter()
+        try:
+            return callback(*args)
+        finally:
+            if flask.has_request_context(): # not when called directly, e.g. by the benchmarks
+                flask.g.callback_seconds = time.perf_counter()-t
+    return wrapper
+
+# function below sets the colors based on the missing data fractions x (array like)
 def SetColor(x):
-    if(x < .01):
-        return "green"
-    elif(x >= .01 and x < .05):
-        return "yellow"
-    elif(x >= .05):
-        return "red"
+    x = np.asarray(x)
+    return np.select([x < .01, x < .05, x >= .05], ["green", "yellow", "red"], default=None).tolist()
     
-# function below sets the color based on amount
+# function below sets the sizes based on the series lengths x (array like)
 def SetSize(x):
-    if(x < 20):
-        return 2
-    elif(x >= 20 and x < 100):
-        return 4
-    elif(x >= 100):
-        return 8
+    x = np.asarray(x)
+    return np.select([x < 20, x < 100, x >= 100], [2, 4, 8], default=None).tolist()
+
+# cluster markers grow with the number of stations they stand for
+def SetClusterSize(count):
+    return np.clip(4+2*np.log2(np.asarray(count, dtype=float)), 4, 20)
+
+# function below sets the colors based on trend classes x (array like, mean over a cluster)
+def SetTrendColor(x):
+    x = np.asarray(x, dtype=float)
+    return np.select([x >= 1/3, x <= -1/3], ["blue", "orange"], default="grey").tolist()
+
+def trend_classes(atlas):
+    """TREND_<freq>_<summ> columns of the trend atlas: 1 for a significant increase, -1 for a
+    significant decrease, 0 otherwise (NaN without a fit)"""
+    classes = pd.DataFrame({'STAID': atlas['STAID']})
+    for col in atlas.columns[atlas.columns.str.startswith('SLOPE_')]:
+        fit = col[len('SLOPE_'):]
+        significant = atlas['PVALUE_'+fit] < TREND_ALPHA
+        classes['TREND_'+fit] = np.sign(atlas[col]).where(significant, 0).where(atlas[col].notna())
+    return classes
 
 station_df = rp.stations() 
-graph1data = [ go.Scattermapbox(
-        lat=station_df['LAT'],
-        lon=station_df['LON'],
+atlas = rp.trends()
+if atlas is not None:
+    station_df = station_df.merge(trend_classes(atlas), on='STAID', how='left')
+catalog = StationCatalog(station_df)
+clusters = StationClusters(station_df, extra=[col for col in station_df.columns if col.startswith('TREND_')])
+station_index = StationIndex(station_df)
+MAPZOOM = 4
+SEARCHLIMIT = 50 # stations offered by the dropdown for what is typed in it
+NEIGHBOURS = 2 # stations added by "Compare with neighbours"
+TREND_METHODS = {'ols': ('t-test', 'OLS trend'), 'sen': ('Mann-Kendall', "Sen's slope")} # (test, slope) names, see rp.trend_fits
+WEIGHTINGS = {'mean': 'Mean', 'area': 'Area average'} # of a region's stations, see regional.station_weights
+INCOMPLETE_MARK, INCOMPLETE_COLOR = '·', 'red' # slider marks of years incomplete in a selected series
+
+def trend_column(freq, summ):
+    """the clusters column with the trend classes of freq and summ, None if the atlas has none"""
+    col = 'TREND_{}_{}'.format(freq, rp.SUMMCOLS.get(summ))
+    return col if col in clusters.extra else None
+
+def map_data(zoom=MAPZOOM, bounds=None, color=None):
+    """Map trace with the station clusters or stations (depending on zoom) in bounds,
+    colored by missing data or (color=a trend_column) by trend"""
+    markers = clusters.view(zoom, bounds)
+    single = markers['COUNT'].to_numpy() == 1
+    size = np.where(single, SetSize(markers['LENGTH']), SetClusterSize(markers['COUNT']))
+    return [ go.Scattermapbox(
+        lat=markers['LAT'],
+        lon=markers['LON'],
         mode='markers',
-        text=station_df['TXT'],
+        text=markers['TXT'],
         hoverinfo = 'text',
-        customdata = station_df['STAID'],
+        customdata = markers['STAID'],
         marker=dict(
-            size=list(map(SetSize, station_df['LENGTH'])),
-            color=list(map(SetColor, station_df['MISSING'])),
-            opacity=0.5,
+            size=size,
+            color=SetTrendColor(markers[color]) if color else SetColor(markers['MISSING']),
+            opacity=np.where(single, 0.5, 0.7),
             
         ),
         
     )]
+
+graph1data = map_data()
 graph1layout = go.Layout(
     autosize=True,
     hovermode='closest',
+    uirevision='stationmap', # keep the user's pan/zoom when the markers are replaced
     mapbox=dict(
         accesstoken=mapbox_access_token,
         bearing=0,
@@ -83,7 +196,7 @@ graph1layout = go.Layout(
             lon=15
         ),
         pitch=0,
-        zoom=4,
+        zoom=MAPZOOM,
     ),
     margin=go.layout.Margin(
         l=10,
@@ -115,25 +228,69 @@ name = html.Div([html.Span("Assela Pathirana      (source: European Climate Asse
                          html.Span('1 ≤ m <5', style={'color': 'yellow'}),
                          html.Span(', '),
                          html.Span('5 ≤ m', style={'color': 'red'}),
-                         html.Span("   |   Size increases with length of the series")
+                         html.Span('; or significant trend (p<{}): '.format(TREND_ALPHA)),
+                         html.Span('wetter', style={'color': 'blue'}),
+                         html.Span(', '),
+                         html.Span('drier', style={'color': 'orange'}),
+                         html.Span("   |   Size increases with length of the series (of clusters: with number of stations)")
                          ], className='name')
+mapcolordd = dcc.Dropdown(
+    id='mapcolordd',
+    options=[
+        {'label': 'Color by missing data', 'value': 'MISSING'},
+        {'label': 'Color by trend of the selected frequency and summary', 'value': 'TREND'},
+    ],
+    value='MISSING',
+    clearable=False,
+)
+
 row1 = html.Div([  # row 1 start ([
         html.Div(
-            [graph1],
+            [graph1, mapcolordd],
             className="twelve columns"),
 ], className="row")  # row 1 end ])
 
 
-def plot_ts(pts, trange, freq, summ):
-    #print("TRANGE:", trange, file=sys.stderr)
-    pts=[int(pt) for pt in pts]
+def plot_ts(pts, trange, freq, summ, xrange=None, method='ols'):
+    """Chart of the stations pts with their trend lines by method (see TREND_METHODS). Series longer
+    than MAXPOINTS are downsampled, densest in the visible xrange=(start, end) of the date axis."""
+    return chart(result_key(pts, trange, freq, summ, method=method), xrange)
+
+def chart(key, xrange=None):
+    """Chart of a result_key, shared between processes through rp.disk_cache until one of
+    the stations' source files changes. The xrange is only part of the cache key when a series
+    is downsampled; other charts look the same at any zoom."""
+    stamp = result_stamp(key)
+    if xrange is not None and not downsampled(key, stamp):
+        xrange = None
+    ckey = ('figure', rp.CACHE_VERSION, MAXPOINTS, key, None if xrange is None else [str(x) for x in xrange])
+    cached = rp.disk_cache.get_bytes(ckey, stamp) if rp.disk_cache else None
+    if cached is not None:
+        return json.loads(cached)
+    text = json.dumps(plot_result(station_result(key, stamp), xrange), cls=plotly.utils.PlotlyJSONEncoder)
+    if rp.disk_cache:
+        rp.disk_cache.put_bytes(ckey, stamp, text.encode())
+    return json.loads(text) # the same whether cached or not
+
+def downsampled(key, stamp):
+    """whether a series of the result of key is longer than MAXPOINTS, remembered in rp.disk_cache"""
+    dkey = ('downsampled', rp.CACHE_VERSION, MAXPOINTS, key)
+    flag = rp.disk_cache.get_bytes(dkey, stamp) if rp.disk_cache else None
+    if flag is None:
+        flag = b'1' if any(len(data) > MAXPOINTS for data in station_result(key, stamp)['series']) else b'0'
+        if rp.disk_cache:
+            rp.disk_cache.put_bytes(dkey, stamp, flag)
+    return flag == b'1'
+
+def plot_result(res, xrange=None):
+    """Chart of a result of compute_result"""
+    with stage('figure', res['freq']):
+        return _plot_result(res, xrange)
+
+def _plot_result(res, xrange):
+    trange = res['trange']
     traces =[]
-    for i,pt in enumerate(pts):
-        #print("1:", file=sys.stderr)
-        data = resampled(pt,freq, summ)
-        #print("2:", file=sys.stderr)
-        data = _subset_to_range(trange, data)
-        #print("3:", file=sys.stderr)
+    for i,(label, data, (yfit, pval, mval)) in enumerate(zip(res['labels'], res['series'], res['fits'])):
         marker = dict(
             size = 5,
             color=COLORS[i%10],
@@ -142,16 +299,13 @@ def plot_ts(pts, trange, freq, summ):
                 color=COLORS[i%10],
             )
         ) 
-        if (data['Rainfall_mm'].count()>=2): # at least 2 non-Nan values
-            yfit, pval, mval = rp.linear_fit(data)
-        else:
-            yfit=[]
-            pval=1.0
+        ind = view_indices(data.index.to_numpy(), data['Rainfall_mm'].to_numpy(), MAXPOINTS, xrange)
+        data, yfit = data.iloc[ind], yfit.iloc[ind]
         
         traces.append(go.Scatter(
             x=data.index,
             y=data['Rainfall_mm'],
-            name=station_df.iloc[pt]['TXT']+" [subset: {}y with trend={:.3f}, p={:.3f}]".format(trange[1]-trange[0]+2, mval, pval),
+            name=label+" [subset: {}y with {}={:.3f}, p={:.3f}]".format(trange[1]-trange[0]+2, TREND_METHODS[res['method']][1], mval, pval),
             mode="markers+lines",
             marker=marker,       
         ))
@@ -162,6 +316,7 @@ def plot_ts(pts, trange, freq, summ):
                                 marker=marker,))
     layout=go.Layout(
         #title="Annual Rainfall",
+        uirevision='stationgraph', # keep the zoom when the downsampled points are replaced
         showlegend= True,
         legend=dict(x=.1,y=1.0),
         xaxis=dict(
@@ -182,21 +337,86 @@ def plot_ts(pts, trange, freq, summ):
         'layout': layout
     }
 
-def _subset_to_range(trange, data):
-    if(trange):
-        data=data['{}-01-01'.format(trange[0]):'{}-01-01'.format(trange[1]+1)]
-    return data
+def trend_stats(fits, method):
+    """stats table columns of the slope and p-value of each fit"""
+    name, slope = TREND_METHODS[method]
+    return {slope: ["{:.3g}".format(mval) for _, _, mval in fits],
+            'p ({})'.format(name): ["{:.3f}".format(pval) for _, pval, _ in fits]}
+
+def compute_result(pts, trange, freq, summ, method='ols'):
+    """Everything the chart, stats table and download show for a selection, computed once:
+    the subsetted series of the stations pts, their trend fits by method and the stats table columns."""
+    dfs=_df_list(pts, freq, trange, summ)
+    fits=rp.station_trends([catalog.staid(pt) for pt in pts], dfs, freq, summ, trange, method)
+    return dict(pts=pts, trange=trange, freq=freq, summ=summ, method=method, series=dfs,
+                labels=[catalog.labels[pt] for pt in pts], names=[catalog.names[pt] for pt in pts],
+                fits=fits,
+                stats={**staindex2stadesc(pts), **rp.stats(dfs), **trend_stats(fits, method)})
+
+def region_rows(region):
+    """rows of the stations of a region, dict(bounds=(west, south, east, north) or None for all, weighting)"""
+    return station_index.within(region['bounds']) if region['bounds'] else np.arange(len(catalog))
+
+def compute_region_result(region, trange, freq, summ, method='ols'):
+    """compute_result for the regional series of all stations in a region (see rp.regional_series)"""
+    rows = region_rows(region)
+    data = rp.regional_series([catalog.staid(r) for r in rows], station_df['LON'].to_numpy()[rows],
+                              station_df['LAT'].to_numpy()[rows], freq, summ, trange, region['weighting'])
+    with stage('fit', freq):
+        fits = rp.trend_fits([data], method)
+    label = '{} of {} stations'.format(WEIGHTINGS[region['weighting']], len(rows))
+    bounds = '{:.2f}/{:.2f} to {:.2f}/{:.2f}'.format(*region['bounds']) if region['bounds'] else 'all'
+    return dict(pts=[], trange=trange, freq=freq, summ=summ, method=method, series=[data], labels=[label], names=['Region'],
+                fits=fits, stats={'Station': [label], 'Country': [''], 'Elev.': [''], 'LON/LAT': [bounds],
+                                  **rp.stats([data]), **trend_stats(fits, method)})
+
+def result_key(value, trange, freq, summ, region=None, method='ols'):
+    if region:
+        return json.dumps(dict(stations=[], region=region, trange=trange, freq=freq, summ=summ, trend=method), sort_keys=True)
+    return json.dumps(dict(stations=[catalog.staid(int(pt)) for pt in value[-MAXSTATIONS:]], trange=trange, freq=freq, summ=summ, trend=method), sort_keys=True)
+
+def result_stamp(key):
+    """changes whenever the result of a result_key may change: the stamps of its stations'
+    resampled sources, or of the daily matrix for a region"""
+    q = json.loads(key)
+    return tuple(rp.series_stamp(s, q['freq']) for s in q['stations']) or (rp.daily_matrix.stamp(),)
+
+def station_result(key, stamp=None):
+    """The result of a result_key, from the results store unless its sources changed since (see
+    result_stamp, or the stamp given), or computed (e.g. when the key was stored by another worker
+    process). Identical requests in flight share one computation, which runs on compute_pool;
+    raises Overloaded if that is full."""
+    stamp = result_stamp(key) if stamp is None else stamp
+    res = results.get(key, stamp)
+    if res is None:
+        res = selection_flights.do((key, stamp), compute_pool.run, _compute_key, key, stamp)
+    return res
+
+def _compute_key(key, stamp):
+    q = json.loads(key)
+    t = time.perf_counter()
+    if q.get('region'):
+        res = compute_region_result(q['region'], q['trange'], q['freq'], q['summ'], q['trend'])
+    else:
+        res = compute_result([catalog.row(s) for s in q['stations']], q['trange'], q['freq'], q['summ'], q['trend'])
+    t = time.perf_counter()-t
+    REGISTRY.observe('rainfall_selection_seconds', t, freq=q['freq'], summ=rp.SUMMCOLS.get(q['summ'], ''))
+    if t > SLOW_SELECTION:
+        REGISTRY.inc('rainfall_slow_selections_total', stations=','.join(q['stations']), freq=q['freq'])
+    results.put(key, stamp, res)
+    return res
 
-def resampled(pt, freq, summ):
-    data=rp.resampled(station_df.iloc[pt]['STAID'], freq, summ)
+def resampled(pt, freq, summ, trange=None):
+    data=rp.resampled(catalog.staid(pt), freq, summ, trange)
     return data
 
 try:
-    init_ind=station_df[station_df['STAID']=='RR_STAID000162'].index[0] # De Buit (NL)
-except:
-    init_ind=station_df[station_df['STAID']=='RR_STAID000001'].index[0] # #  for testing
+    init_ind=catalog.row('RR_STAID000162') # De Buit (NL)
+except KeyError:
+    init_ind=catalog.row('RR_STAID000001') # #  for testing
 
 graph2= dcc.Graph(id='stationgraph', config=CONFIG)
+result_store = dcc.Store(id='result-key') # key of the current selection's entry in results
 stat_display = html.Div(id='statdisplay')
 
 row2 = html.Div([
@@ -206,22 +426,35 @@ row3 = html.Div([
     html.Div([stat_display]),
     ], className='row')
 
+def station_options(value, rows=()):
+    """dropdown options of the selected stations value followed by rows (e.g. search results)"""
+    selected = {}
+    for v in value or []:
+        selected.setdefault(int(v), v)
+    return ([dict(label=catalog.labels[r], value=v, search=catalog.searches[r]) for r, v in selected.items()] +
+            [dict(label=catalog.labels[r], value=r, search=catalog.searches[r]) for r in rows if r not in selected])
+
 sdd=dcc.Dropdown(
     id = 'station_dd',
-    options=[dict(label=x[1], value=x[0]) for x in station_df['TXT'].to_dict().items()],
+    options=station_options([str(init_ind)]), # the rest is searched as the user types, see update_station_options
     value=[str(init_ind)],
+    placeholder='Type to search stations',
     multi=True
 )
+neighboursbutton = html.Button('Compare with neighbours', id='neighbours-button')
+regionmode = dcc.RadioItems(
+    id='regionmode',
+    options=[{'label': 'Selected stations', 'value': ''}] +
+            [{'label': '{} of all stations in the map view'.format(label), 'value': w} for w, label in WEIGHTINGS.items()],
+    value='',
+    inline=True,
+)
 
 timeslidediv=html.Div([dcc.RangeSlider(id='time_range')], id='slider_container', className='slider-box')
 freqdd=html.Div([
     dcc.Dropdown(
         id='freqdd',
-        options=[
-            {'label': 'Yearly', 'value': 'Y'},
-            {'label': 'Monthly', 'value': 'M'},
-           # {'label': 'Daily', 'value': '24H'}
-        ],
+        options=[{'label': p.label, 'value': freq} for freq, p in periods.PERIODS.items()],
         value='YE',
     )
 ])
@@ -237,10 +470,25 @@ summarydd=html.Div([
     )    
 ])
 
+trenddd=html.Div([
+    dcc.Dropdown(
+        id='trenddd',
+        options=[
+            {'label': 'Least squares trend', 'value': 'ols'},
+            {'label': "Sen's slope, Mann-Kendall test", 'value': 'sen'},
+        ],
+        value='ols',
+        clearable=False,
+    )
+])
+
 toolbar = html.Div([
     html.Div([sdd]),
+    neighboursbutton,
+    regionmode,
     summarydd,
     freqdd,
+    trenddd,
     timeslidediv,
     ], className='row')
 
@@ -252,9 +500,16 @@ downloadl = html.A(
         href="",
         target="_blank"
  )
+downloadpq = html.A(
+     '(Parquet)',
+        id='download-link-parquet',
+        download="rawdata.parquet",
+        href="",
+        target="_blank"
+ )
 
 row4=html.Div([
-    html.Div([downloadl])
+    html.Div([downloadl, ' ', downloadpq])
     ], className='row')
 
 app.layout = html.Div([  # begin container
@@ -265,28 +520,106 @@ app.layout = html.Div([  # begin container
     row2,
     row3,
     row4,
+    result_store,
 ], className="container",
 )  # end container
 
 
 @app.callback(
-    dash.dependencies.Output('download-link', 'href'),
+    dash.dependencies.Output('result-key', 'data'),
     [dash.dependencies.Input('station_dd', 'value'),
      dash.dependencies.Input('time_range','value'),
      dash.dependencies.Input('freqdd','value'), 
-     dash.dependencies.Input('summarydd', 'value')
+     dash.dependencies.Input('summarydd', 'value'),
+     dash.dependencies.Input('regionmode', 'value'),
+     dash.dependencies.Input('stationmap', 'relayoutData'),
+     dash.dependencies.Input('trenddd', 'value'),
      ])
-def update_download_link(value, trange, freq, summarydd):
-    dff=_dfs_list_as_one_df(value, trange, freq, summarydd)
-    csv_string = dff.to_csv(index=True, encoding='utf-8')
-    csv_string = "data:text/csv;charset=utf-8," + urllib.parse.quote(csv_string)
-    return csv_string
-
-def _dfs_list_as_one_df(value, trange, freq, summarydd):
-    pts=[int(pt) for pt in value[-3:]]
-    dfs=_df_list(pts, freq, trange, summarydd)
+@timed
+def compute_selection(value, trange, freq, summ, regionmode, relayoutData, method):
+    """The one callback that reads and resamples data; chart, stats and download render from its result.
+    In a region mode the selection is all stations in the map view, so it follows the map."""
+    try:
+        freq = periods.canonical(freq)
+    except KeyError:
+        raise dash.exceptions.PreventUpdate
+    region = None
+    if regionmode:
+        region = dict(bounds=viewport(relayoutData, MAPZOOM)[1], weighting=regionmode)
+        if not len(region_rows(region)):
+            raise dash.exceptions.PreventUpdate
+    elif not value or 'stationmap.relayoutData' in [t['prop_id'] for t in dash.callback_context.triggered]:
+        raise dash.exceptions.PreventUpdate
+    key = result_key(value, trange, freq, summ, region, method)
+    station_result(key)
+    return key
+
+@app.callback(
+    [dash.dependencies.Output('download-link', 'href'),
+     dash.dependencies.Output('download-link-parquet', 'href')],
+    [dash.dependencies.Input('result-key', 'data')])
+@timed
+def update_download_link(key):
+    """Links to /download; the data is only built when one is followed."""
+    if not key:
+        raise dash.exceptions.PreventUpdate
+    q = json.loads(key)
+    query = dict(stations=','.join(q['stations']), freq=q['freq'], summ=q['summ'])
+    if q.get('region'):
+        query['weighting'] = q['region']['weighting']
+        if q['region']['bounds']:
+            query['bounds'] = ','.join(str(b) for b in q['region']['bounds'])
+    if q['trange']:
+        query['range'] = '{},{}'.format(*q['trange'])
+    return [app.get_relative_path('/download') + '?' + urllib.parse.urlencode(dict(query, format=fmt))
+            for fmt in ('csv', 'parquet')]
+
+@server.route('/download')
+def download():
+    """Joined series of ?stations=STAID,... (at most MAXSTATIONS) or of the region weighting=mean|area and
+    optionally bounds=west,south,east,north, for freq (a period type, see periods.py), summ and optionally range=start,end (years),
+    as a streamed csv or (format=parquet) a parquet file."""
+    args = flask.request.args
+    try:
+        region = None
+        if args.get('weighting'):
+            bounds = [float(b) for b in args['bounds'].split(',')] if args.get('bounds') else None
+            region, pts = dict(bounds=bounds, weighting=args['weighting']), []
+        else:
+            pts = [catalog.row(s) for s in args['stations'].split(',')]
+        trange = [int(y) for y in args['range'].split(',')] if args.get('range') else None
+        freq, summ, fmt = periods.canonical(args.get('freq', 'YE')), int(args.get('summ', rp.TOTAL)), args.get('format', 'csv')
+    except (KeyError, ValueError):
+        flask.abort(400)
+    if summ not in rp.SUMMCOLS or fmt not in ('csv', 'parquet'):
+        flask.abort(400)
+    if trange is not None and not (len(trange) == 2 and trange[0] <= trange[1]):
+        flask.abort(400)
+    if len(pts) > MAXSTATIONS: # rather than export only the last ones, as result_key would
+        flask.abort(400)
+    if not (pts or region and region['weighting'] in WEIGHTINGS and (region['bounds'] is None or len(region['bounds']) == 4)):
+        flask.abort(400)
+    if region and not len(region_rows(region)): # as compute_selection, no series without stations
+        flask.abort(400)
+    dff=_dfs_list_as_one_df(pts, trange, freq, summ, region)
+    if fmt == 'parquet':
+        buf = io.BytesIO()
+        dff.to_parquet(buf)
+        return flask.Response(buf.getvalue(), mimetype='application/vnd.apache.parquet',
+                              headers={'Content-Disposition': 'attachment; filename=rawdata.parquet'})
+    return flask.Response(flask.stream_with_context(_csv_chunks(dff)), mimetype='text/csv',
+                          headers={'Content-Disposition': 'attachment; filename=rawdata.csv'})
+
+def _csv_chunks(dff):
+    yield dff.iloc[:0].to_csv(index=True)
+    for i in range(0, len(dff), CSVCHUNK):
+        yield dff.iloc[i:i+CSVCHUNK].to_csv(index=True, header=False)
+
+def _dfs_list_as_one_df(value, trange, freq, summarydd, region=None):
+    res=station_result(result_key(value, trange, freq, summarydd, region))
+    names, dfs = res['names'], list(res['series'])
     for i in range(len(dfs)):
-        dfs[i]=dfs[i].rename(columns={"Rainfall_mm":station_df.iloc[pts[i]]['STANAME']})
+        dfs[i]=dfs[i].rename(columns={"Rainfall_mm":names[i]})
     dff=dfs[0] # first
     for i in range(1,len(dfs)):
         dff=dff.join(dfs[i],rsuffix='_{:1d}'.format(i), how='outer')
@@ -298,45 +631,52 @@ def _dfs_list_as_one_df(value, trange, freq, summarydd):
     [dash.dependencies.Input('station_dd', 'value'),
     ]
 )
+@timed
 def new_slider(value):
-    dfs=[resampled(int(v),'YE', rp.TOTAL) for v in value] # keep this annual. We just need limits as years. 
-    mint,maxt=rp.get_timelimits(dfs)
+    pts=[int(v) for v in value]
+    extent=catalog.extent(pts) # recorded at ingestion, no data is read
+    recorded=extent is not None
+    if not recorded: # stations.feather of an older ingestion
+        dfs=[resampled(pt,'YE', rp.TOTAL) for pt in pts] # keep this annual. We just need limits as years. 
+        extent=rp.get_timelimits(dfs)
+    mint,maxt=extent
     
     marks={int(x):str(int(x)) for x in rp.auto_tick([mint,maxt],max_tick=10)}
     ticks={int(x):'' for x in rp.auto_tick([mint,maxt],max_tick=20)}
-    print("XXX:", marks, file=sys.stderr)
+    marks={
+        mint: "",
+        **ticks,
+        **marks,
+        maxt: "",                
+    }
+    if recorded:
+        for year in catalog.incomplete_years(pts, mint, maxt): # shade years failing the completeness rule of periods.py
+            marks[year]={'label': marks.get(year) or INCOMPLETE_MARK, 'style': {'color': INCOMPLETE_COLOR}}
     sli=dcc.RangeSlider(
         id='time_range',
             min=mint,
             max=maxt,
             step=1,
             value=[mint,maxt],
-            marks={
-                mint: "",
-                **ticks,
-                **marks,
-                maxt: "",                
-            },
-            
-            
+            marks=marks,
     )    
     return sli
 
 @app.callback(
     dash.dependencies.Output('statdisplay', 'children'),
-    [dash.dependencies.Input('station_dd', 'value'),
-     dash.dependencies.Input('time_range','value'),
-     dash.dependencies.Input('freqdd','value'),
-     dash.dependencies.Input('summarydd','value'),
-     
+    [dash.dependencies.Input('result-key', 'data'),
     ]
 )
-def display_stats(value, trange, freq, summ):
-    print("STAT:", value, file=sys.stderr)
-    return stats_astable(value[-3:], trange, freq, summ)
+@timed
+def display_stats(key):
+    if not key:
+        raise dash.exceptions.PreventUpdate
+    return stats_table(station_result(key)['stats'])
 
 def stats_astable(pts, trange, freq, summ):
-    alls=stat_from_indexes(pts, trange, freq, summ)   
+    return stats_table(stat_from_indexes(pts, trange, freq, summ))
+
+def stats_table(alls):
     return html.Table(
         [html.Tr( [html.Th(x) for x in alls.keys()] )] 
         + 
@@ -352,50 +692,86 @@ def stat_from_indexes(pts, trange, freq, summ):
 def _df_list(pts, freq, trange, summ):
     dfs=[]
     for pt in pts:
-        data=resampled(pt, freq, summ)
-        data=_subset_to_range(trange, data)
+        data=resampled(pt, freq, summ, trange) # only the years of trange are read
         dfs.append(data)
     return dfs
 
 @app.callback(
     dash.dependencies.Output('station_dd', 'value'),
-   [dash.dependencies.Input('stationmap', 'clickData')
+   [dash.dependencies.Input('stationmap', 'clickData'),
+    dash.dependencies.Input('neighbours-button', 'n_clicks'),
     ],
    [dash.dependencies.State('station_dd','value')]
 )
-def update_station_dd(clickData, dd_value):
+@timed
+def update_station_dd(clickData, n_clicks, dd_value):
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'neighbours-button.n_clicks' in triggered:
+        if not dd_value:
+            raise dash.exceptions.PreventUpdate
+        last = int(dd_value[-1])
+        return [last] + station_index.neighbours(last, NEIGHBOURS)
     if (clickData):
         pts = mapClickData2staindex(clickData)
     else:
         pts=[]
-    return (dd_value+pts)[-3:]
+    return (dd_value+pts)[-MAXSTATIONS:]
+
+@app.callback(
+    dash.dependencies.Output('station_dd', 'options'),
+   [dash.dependencies.Input('station_dd', 'search_value'),
+    dash.dependencies.Input('station_dd', 'value'),
+    ],
+)
+@timed
+def update_station_options(search_value, value):
+    """the selected stations and the first SEARCHLIMIT matches of what is typed, instead of all stations"""
+    return station_options(value, catalog.search(search_value, SEARCHLIMIT) if search_value else ())
 
 @app.callback(
    dash.dependencies.Output('stationgraph', 'figure'),
-   [dash.dependencies.Input('station_dd', 'value'),
-    dash.dependencies.Input('time_range','value'),
-    dash.dependencies.Input('freqdd','value'), 
-    dash.dependencies.Input('summarydd','value'),
+   [dash.dependencies.Input('result-key', 'data'),
+    dash.dependencies.Input('stationgraph','relayoutData'),
     ],
 )
-def display_chart(value, trange,freq, summ):
-    #print("CHART:", value, file=sys.stderr)
-    return plot_ts(value[-3:], trange, freq, summ)
+@timed
+def display_chart(key, relayoutData):
+    #print("CHART:", key, file=sys.stderr)
+    if not key:
+        raise dash.exceptions.PreventUpdate
+    return chart(key, relayout2xrange(relayoutData))
+
+def relayout2xrange(relayoutData):
+    """visible (start, end) of the date axis after a zoom or range slider move, None if autoranged"""
+    if not relayoutData or relayoutData.get('xaxis.autorange'):
+        return None
+    xr = relayoutData.get('xaxis.range') or [relayoutData.get('xaxis.range[0]'), relayoutData.get('xaxis.range[1]')]
+    if None in xr:
+        return None
+    return tuple(np.datetime64(pd.Timestamp(x), 'ns') for x in xr)
 
 def mapClickData2staindex(clickData):
     pts=[]
     for pt in clickData['points']:
-        pts.append(station_df[station_df['STAID']==pt['customdata']].index[0])
+        if pt.get('customdata') in catalog.rows: # clusters have no STAID
+            pts.append(catalog.row(pt['customdata']))
     return pts
 
+@app.callback(
+    dash.dependencies.Output('stationmap', 'figure'),
+    [dash.dependencies.Input('stationmap', 'relayoutData'),
+     dash.dependencies.Input('mapcolordd', 'value'),
+     dash.dependencies.Input('freqdd', 'value'),
+     dash.dependencies.Input('summarydd', 'value')],
+)
+@timed
+def update_map(relayoutData, colorby, freq, summ):
+    zoom, bounds = viewport(relayoutData, MAPZOOM)
+    color = trend_column(freq, summ) if colorby == 'TREND' else None
+    return dict(data=map_data(zoom, bounds, color), layout=graph1layout)
+
 def staindex2stadesc(pts):
-    res={'Station':[], 'Country':[], 'Elev.':[], 'LON/LAT':[]}
-    for pt in pts:
-        res['Station'].append(station_df.iloc[pt]['STANAME'])
-        res['Country'].append(pycountry.countries.get(alpha_3=station_df.iloc[pt]['CN']).name)
-        res['Elev.'].append('{:4.0f}'.format(station_df.iloc[pt]['HGHT']))
-        res['LON/LAT'].append('{:3.2f}/{:3.2f}'.format(station_df.iloc[pt]['LON'],station_df.iloc[pt]['LAT']))
-    return res
+    return catalog.describe(pts)
 
 
 
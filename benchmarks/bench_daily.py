@@ -0,0 +1,47 @@
+"""Payload size and latency of the daily chart with and without downsampling.
+
+    python benchmarks/bench_daily.py [STAID]
+
+Run it from the directory that holds ./data; defaults to the longest station.
+"""
+import json
+import os
+import sys
+import time
+
+import plotly
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app
+
+REPEAT = 5
+
+
+def measure(pt, trange, xrange):
+    best = float('inf')
+    for _ in range(REPEAT):
+        t = time.perf_counter()
+        fig = app.plot_ts([pt], trange, '24H', app.rp.TOTAL, xrange)
+        payload = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+        best = min(best, time.perf_counter()-t)
+    return len(fig['data'][0]['x']), len(payload), best
+
+def main(staid=None):
+    app.rp.disk_cache = None # time the charts, not reading them back from data/cache
+    pt = app.catalog.row(staid) if staid else int(app.station_df['LENGTH'].idxmax())
+    data = app.resampled(pt, '24H', app.rp.TOTAL)
+    trange = [data.index[0].year, data.index[-1].year]
+    mid = data.index[len(data)//2]
+    print("{}: {} days".format(app.catalog.labels[pt], len(data)))
+    print("{:28s} {:>8s} {:>12s} {:>10s}".format('', 'points', 'payload kB', 'ms'))
+    maxpoints = app.MAXPOINTS
+    for name, mp, xrange in (('full series', 10**9, None),
+                             ('downsampled, whole range', maxpoints, None),
+                             ('downsampled, 5y zoom', maxpoints, (mid.to_datetime64(), (mid+app.pd.DateOffset(years=5)).to_datetime64()))):
+        app.MAXPOINTS = mp
+        n, size, dt = measure(pt, trange, xrange)
+        print("{:28s} {:8d} {:12.1f} {:10.1f}".format(name, n, size/1024, dt*1e3))
+    app.MAXPOINTS = maxpoints
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
@@ -0,0 +1,54 @@
+"""Throughput (MB/s) of rainproc.read_rain_from_csv against the previous per-cell converter parser.
+
+    python benchmarks/bench_parser.py [RR_STAID*.txt ...]
+
+Without arguments the files in ./data/eca_blend_rr are used.
+"""
+import glob
+import os
+import sys
+import time
+
+import chardet
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rainproc as rp
+
+
+def legacy_read_rain_from_csv(file):
+    tomm= lambda x: np.nan if float(x) < 0 else 0.1*float(x) # negative values = missing data
+    with open(file,'rb') as f:
+        data = f.read()
+    encoding=chardet.detect(data).get("encoding")
+    df = pd.read_csv(file, encoding=encoding, names=["Date", "Rainfall_mm"], index_col="Date", usecols=[2,3], header=15, parse_dates=['Date'], converters={'Rainfall_mm':tomm})
+    df.replace(-9999, np.nan, inplace=True)
+    return df.reset_index()
+
+def throughput(reader, files, repeat=3):
+    """best MB/s of `repeat` passes of reader over files"""
+    nbytes = sum(os.path.getsize(f) for f in files)
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for f in files:
+            reader(f)
+        best = min(best, time.perf_counter()-t)
+    return nbytes/1024**2/best
+
+def main(files):
+    if not files:
+        files = sorted(glob.glob(rp.rain_csv.format('RR_STAID*')))
+    if not files:
+        sys.exit("no RR_STAID*.txt files to parse")
+    for f in files[:5]:
+        pd.testing.assert_frame_equal(legacy_read_rain_from_csv(f), rp.read_rain_from_csv(f))
+    old = throughput(legacy_read_rain_from_csv, files)
+    new = throughput(rp.read_rain_from_csv, files)
+    print("{} files, {:.1f} MB".format(len(files), sum(os.path.getsize(f) for f in files)/1024**2))
+    print("legacy parser  {:8.2f} MB/s".format(old))
+    print("vectorized     {:8.2f} MB/s  ({:.1f}x)".format(new, new/old))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,75 @@
+"""Latency of a regional series through the stations x days matrix against averaging resampled series.
+
+    python benchmarks/bench_regional.py [--stations 10 100 1000] [--years 30 120]
+
+Writes synthetic stations straight into a feather store (and their aggregate files) in a
+temporary directory, builds the daily matrix from it and times rainproc.regional_series for
+the first n stations, with the matrix and without it (the per-station resampled fallback).
+The in-memory cache is cleared before every call and the disk cache is disabled.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+os.environ['RAINFALL_CACHE_DIR'] = ''
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+
+import rainproc as rp
+import synthetic
+from store import DailyMatrix
+
+FREQS = ('YE', 'ME', 'SEASON')
+REPEAT = 3
+
+
+def write_stations(n, years, seed=0):
+    """n synthetic stations in ./data/feather; returns their STAID, LON and LAT"""
+    rng = np.random.default_rng(seed)
+    staids = ['RR_STAID{:06d}'.format(i) for i in range(1, n+1)]
+    for staid in staids:
+        dates, rr = synthetic.daily_series(rng, years)
+        df = pd.DataFrame({'Date': dates, 'Rainfall_mm': np.where(rr < 0, np.nan, 0.1*rr)})
+        rp.station_files.write(staid, df)
+        rp.write_aggregates(staid, df.set_index('Date'))
+    return staids, rng.uniform(0, 30, n), rng.uniform(36, 70, n)
+
+def measure(staids, lon, lat, freq):
+    best = float('inf')
+    for _ in range(REPEAT):
+        rp.resample_cache.clear()
+        t = time.perf_counter()
+        rp.regional_series(staids, lon, lat, freq, rp.TOTAL, weighting='area')
+        best = min(best, time.perf_counter()-t)
+    return best
+
+def main(sizes, years):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.makedirs('data/feather')
+        staids, lon, lat = write_stations(max(sizes), years)
+        first, last = pd.Timestamp(synthetic.LASTDAY)-pd.DateOffset(years=years[1]), pd.Timestamp(synthetic.LASTDAY)
+        t = time.perf_counter()
+        rp.daily_matrix.build(rp.station_files, staids, first, last)
+        print("matrix of {} stations x {} days: {:.0f} MB, built in {:.1f} s".format(
+            len(staids), (last-first).days+1, 4*len(staids)*((last-first).days+1)/1024**2, time.perf_counter()-t))
+        matrix, none = rp.daily_matrix, DailyMatrix(os.path.join(tmp, 'none.npy'))
+        print("{:>8s} {:>5s} {:>12s} {:>14s} {:>8s}".format('stations', 'freq', 'matrix ms', 'resampled ms', 'speedup'))
+        for n in sizes:
+            for freq in FREQS:
+                rp.daily_matrix = matrix
+                fast = measure(staids[:n], lon[:n], lat[:n], freq)
+                rp.daily_matrix = none
+                slow = measure(staids[:n], lon[:n], lat[:n], freq)
+                print("{:8d} {:>5s} {:12.1f} {:14.1f} {:8.1f}".format(n, freq, fast*1e3, slow*1e3, slow/fast))
+        rp.daily_matrix = matrix
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--stations', type=int, nargs='+', default=[10, 100, 1000])
+    ap.add_argument('--years', type=int, nargs=2, default=(30, 120))
+    a = ap.parse_args()
+    main(a.stations, tuple(a.years))
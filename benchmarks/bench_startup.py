@@ -0,0 +1,40 @@
+"""Cold start of app.py: import time and time to first response, each measured in a fresh interpreter.
+
+    python benchmarks/bench_startup.py [runs]
+
+Run it from the directory that holds ./data (as the app is run).
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PROBE = r'''
+import sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app
+t1 = time.perf_counter()
+client = app.server.test_client()
+assert client.get('/').status_code == 200
+t2 = time.perf_counter()
+assert client.get('/_dash-layout').status_code == 200
+t3 = time.perf_counter()
+print(t1-t0, t2-t1, t3-t2)
+'''
+
+def probe():
+    out = subprocess.run([sys.executable, '-W', 'ignore', '-c', PROBE.format(root=ROOT)],
+                         check=True, capture_output=True, text=True).stdout
+    return [float(x) for x in out.split()]
+
+def main(runs=5):
+    res = [probe() for _ in range(runs)]
+    for i, name in enumerate(('import app', 'first GET /', 'first GET /_dash-layout')):
+        vals = sorted(r[i] for r in res)
+        print("{:24s} median {:7.1f} ms   min {:7.1f} ms".format(name, vals[len(vals)//2]*1e3, vals[0]*1e3))
+    print("{:24s} median {:7.1f} ms".format('time to first response', sorted(r[0]+r[1] for r in res)[runs//2]*1e3))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
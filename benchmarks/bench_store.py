@@ -0,0 +1,60 @@
+"""Read latency and per-worker RSS of the per-station feather layout against the consolidated Arrow file.
+
+    python benchmarks/bench_store.py [n_stations]
+
+Uses the stations in ./data/feather. The Arrow file is built in a temporary directory
+from the feather files, so the live store is left alone. Every measurement runs in a
+fresh process: 'cold' is the first pass over the stations (file opens, mapping the
+Arrow file), 'warm' the mean of the following passes.
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rainproc as rp
+from store import ArrowStore, FeatherStore
+
+PASSES = 5
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*resource.getpagesize()/1024**2
+
+def _measure(layout, path, staids, queue):
+    store = ArrowStore(path) if layout == 'arrow' else FeatherStore(path)
+    base = rss_mb()
+    times = []
+    for _ in range(PASSES):
+        t = time.perf_counter()
+        for staid in staids:
+            store.read(staid)
+        times.append((time.perf_counter()-t)/len(staids))
+    queue.put((times[0], sum(times[1:])/(PASSES-1), rss_mb()-base))
+
+def measure(layout, path, staids):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=_measure, args=(layout, path, staids, queue))
+    p.start()
+    res = queue.get()
+    p.join()
+    return res
+
+def main(n=None):
+    staids = list(rp.stations()['STAID'])[:n]
+    with tempfile.TemporaryDirectory() as tmp:
+        arrow = os.path.join(tmp, 'rainfall.arrow')
+        ArrowStore(arrow).consolidate(rp.station_files, staids)
+        print("{} stations".format(len(staids)))
+        print("{:8s} {:>12s} {:>12s} {:>14s}".format('layout', 'cold ms/stn', 'warm ms/stn', 'RSS delta MB'))
+        for layout, path in (('feather', rp.feather_store), ('arrow', arrow)):
+            cold, warm, rss = measure(layout, path, staids)
+            print("{:8s} {:12.3f} {:12.3f} {:14.1f}".format(layout, cold*1e3, warm*1e3, rss))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else None)
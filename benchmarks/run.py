@@ -0,0 +1,150 @@
+"""Benchmark suite on a synthetic ECA&D dataset.
+
+    python benchmarks/run.py [--stations 30] [--years 30 120] [--workers N] [--save] [--compare RESULTS.json]
+
+Generates the dataset (see synthetic.py) in a temporary directory, ingests it
+and times parsing, pre_process, resampled for every freq/summ, linear_fit,
+plot_ts and a full Dash interaction through the Flask test client (from cold
+caches, and with only the shared disk cache warm). With --save
+the timings are written to benchmarks/results/<git commit>.json; --compare
+prints the ratio against such a file from another commit.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+RESULTS = os.path.join(HERE, 'results')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import periods
+import synthetic
+
+FREQS = tuple(periods.PERIODS) # every period type the app offers
+
+
+def timed(fn, repeat=5, setup=None):
+    """median seconds of repeat calls of fn (setup() runs untimed before each)"""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-t)
+    return statistics.median(times)
+
+def git_commit():
+    try:
+        sha = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                             capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return sha+('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def dash_update(client, output, outputs, inputs, changed):
+    """POST one callback the way the browser does; returns its response"""
+    body = dict(output=output, outputs=outputs, inputs=inputs, changedPropIds=changed, state=[])
+    r = client.post('/_dash-update-component', json=body)
+    assert r.status_code in (200, 204), r.status_code
+    return r.get_json() if r.status_code == 200 else None
+
+def interaction(client, pts, trange, freq, summ):
+    """what the browser requests after a control change: the computation, then chart, stats and links"""
+    inputs = [dict(id='station_dd', property='value', value=pts), dict(id='time_range', property='value', value=trange),
+              dict(id='freqdd', property='value', value=freq), dict(id='summarydd', property='value', value=summ),
+              dict(id='regionmode', property='value', value=''), dict(id='stationmap', property='relayoutData', value=None),
+              dict(id='trenddd', property='value', value='ols')]
+    res = dash_update(client, 'result-key.data', dict(id='result-key', property='data'), inputs, ['freqdd.value'])
+    key = dict(id='result-key', property='data', value=res['response']['result-key']['data'])
+    dash_update(client, 'stationgraph.figure', dict(id='stationgraph', property='figure'),
+                [key, dict(id='stationgraph', property='relayoutData', value=None)], ['result-key.data'])
+    dash_update(client, 'statdisplay.children', dict(id='statdisplay', property='children'), [key], ['result-key.data'])
+    dash_update(client, '..download-link.href...download-link-parquet.href..',
+                [dict(id='download-link', property='href'), dict(id='download-link-parquet', property='href')],
+                [key], ['result-key.data'])
+
+def run(stations, years, workers):
+    res = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        staids = synthetic.generate(tmp, stations, years)
+        os.chdir(tmp)
+        import rainproc as rp
+
+        files = [rp.rain_csv.format(s) for s in staids]
+        res['read_rain_from_csv'] = timed(lambda: [rp.read_rain_from_csv(f) for f in files], 3)/len(files)
+        res['pre_process'] = timed(lambda: rp.pre_process(workers), 1)
+        res['pre_process_incremental'] = timed(lambda: rp.pre_process(workers, incremental=True), 1)
+
+        staid = staids[0]
+        for freq in FREQS:
+            for summ in rp.SUMMCOLS:
+                name = 'resampled_{}_{}'.format(freq, rp.SUMMCOLS[summ])
+                res[name] = timed(lambda: rp.resampled(staid, freq, summ),
+                                  setup=lambda: (rp.resample_cache.clear(), rp.disk_cache and rp.disk_cache.clear()))
+                res[name+'_cached'] = timed(lambda: rp.resampled(staid, freq, summ))
+        monthly = rp.resampled(staid, 'ME', rp.TOTAL)
+        res['linear_fit_ME'] = timed(lambda: rp.linear_fit(monthly))
+        res['sen_fit_ME'] = timed(lambda: rp.trend_fits([monthly], 'sen'))
+        res['sen_fit_24H'] = timed(lambda: rp.trend_fits([rp.resampled(staid, '24H', rp.TOTAL)], 'sen'), 1)
+
+        import app
+        trange = list(rp.get_timelimits([rp.resampled(staid, 'YE', rp.TOTAL)]))
+        pts = [str(i) for i in range(min(3, len(staids)))]
+        cold = lambda: (rp.resample_cache.clear(), app.results.clear(), rp.disk_cache and rp.disk_cache.clear())
+        warm = lambda: (rp.resample_cache.clear(), app.results.clear()) # as in a fresh worker process
+        for freq in FREQS:
+            res['plot_ts_'+freq] = timed(lambda: app.plot_ts(pts, trange, freq, rp.TOTAL), setup=cold)
+            res['plot_ts_'+freq+'_disk'] = timed(lambda: app.plot_ts(pts, trange, freq, rp.TOTAL), setup=warm)
+        client = app.server.test_client()
+        for freq in FREQS:
+            res['callbacks_'+freq] = timed(lambda: interaction(client, pts, trange, freq, rp.TOTAL), setup=cold)
+            res['callbacks_'+freq+'_disk'] = timed(lambda: interaction(client, pts, trange, freq, rp.TOTAL), setup=warm)
+        os.chdir(cwd)
+    return res
+
+def compare(res, ref):
+    print("{:32s} {:>12s} {:>12s} {:>8s}".format('benchmark', 'ref ms', 'now ms', 'ratio'))
+    for name, t in res.items():
+        old = ref.get(name)
+        print("{:32s} {:>12s} {:12.2f} {:>8s}".format(
+            name, '{:.2f}'.format(old*1e3) if old else '-', t*1e3, '{:.2f}'.format(t/old) if old else '-'))
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--stations', type=int, default=30)
+    ap.add_argument('--years', type=int, nargs=2, default=(30, 120))
+    ap.add_argument('--workers', type=int, default=None)
+    ap.add_argument('--save', action='store_true')
+    ap.add_argument('--compare')
+    a = ap.parse_args()
+
+    res = run(a.stations, tuple(a.years), a.workers)
+    if a.compare:
+        with open(a.compare) as f:
+            compare(res, json.load(f)['results'])
+    else:
+        for name, t in res.items():
+            print("{:32s} {:10.2f} ms".format(name, t*1e3))
+    if a.save:
+        os.makedirs(RESULTS, exist_ok=True)
+        commit = git_commit()
+        path = os.path.join(RESULTS, commit+'.json')
+        with open(path, 'w') as f:
+            json.dump(dict(commit=commit, python=platform.python_version(), machine=platform.machine(),
+                           cpus=os.cpu_count(), stations=a.stations, years=a.years, results=res), f, indent=1)
+        print("saved", path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Synthetic ECA&D blended rainfall dataset: stations.txt and RR_STAID*.txt in the real file format.
+
+    python benchmarks/synthetic.py OUTDIR [--stations 50] [--years 30 120] [--missing 0.05] [--seed 0]
+
+writes OUTDIR/data/eca_blend_rr/ (and an empty OUTDIR/data/feather/), so that
+rainproc.pre_process() can be run with OUTDIR as working directory.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+COUNTRIES = ['NL', 'DE', 'FR', 'SE', 'ES', 'IT', 'GB', 'NO', 'FI', 'PL', 'AT', 'IE']
+LASTDAY = '2020-12-31'
+
+SERIES_HEADER = """EUROPEAN CLIMATE ASSESSMENT & DATASET (ECA&D), file created on 22-03-2024
+THESE DATA CAN BE USED FOR NON-COMMERCIAL RESEARCH AND EDUCATION PROVIDED THAT THE FOLLOWING SOURCE IS ACKNOWLEDGED:
+
+Klein Tank, A.M.G. and Coauthors, 2002. Daily dataset of 20th-century surface
+air temperature and precipitation series for the European Climate Assessment.
+Int. J. of Climatol., 22, 1441-1453.
+Data and metadata available at http://www.ecad.eu
+
+FILE FORMAT (MISSING VALUE CODE IS -9999):
+
+01-06 STAID: Station identifier
+08-13 SOUID: Source identifier
+15-22 DATE : Date YYYYMMDD
+24-28 RR   : precipitation amount in 0.1 mm
+30-34 Q_RR : quality code for RR (0='valid'; 1='suspect'; 9='missing')
+
+This is the blended series of station {name} (STAID: {staid})
+Blended and updated with sources: {souid}
+See file sources.txt and stations.txt for more info.
+
+STAID, SOUID,    DATE,   RR, Q_RR
+"""
+
+STATIONS_HEADER = """EUROPEAN CLIMATE ASSESSMENT & DATASET (ECA&D), file created on 22-03-2024
+THESE DATA CAN BE USED FOR NON-COMMERCIAL RESEARCH AND EDUCATION PROVIDED THAT THE FOLLOWING SOURCE IS ACKNOWLEDGED:
+
+Klein Tank, A.M.G. and Coauthors, 2002. Daily dataset of 20th-century surface
+air temperature and precipitation series for the European Climate Assessment.
+Int. J. of Climatol., 22, 1441-1453.
+Data and metadata available at http://www.ecad.eu
+
+FILE FORMAT (MISSING VALUE CODE IS -9999):
+
+01-05 STAID  : Station identifier
+07-46 STANAME: Station name
+48-49 CN     : Country code (ISO3116 country codes)
+51-59 LAT    : Latitude in degrees:minutes:seconds (+: North, -: South)
+61-70 LON    : Longitude in degrees:minutes:seconds (+: East, -: West)
+72-75 HGHT   : Station elevation in meters
+
+STAID,STANAME                                 ,CN,      LAT,       LON,HGHT
+"""
+
+
+def dms(v, width):
+    """decimal degrees as the +DD:MM:SS of stations.txt (non-negative v only, as rainproc.dms2dd expects)"""
+    d, rest = divmod(round(v*3600), 3600)
+    return '+{:0{w}d}:{:02d}:{:02d}'.format(d, rest//60, rest % 60, w=width)
+
+def write_series(path, staid, name, dates, rr):
+    souid = 100000+staid
+    body = pd.DataFrame({'STAID': staid, 'SOUID': souid, 'DATE': dates.strftime('%Y%m%d'), 'RR': rr,
+                         'Q_RR': np.where(rr < 0, 9, 0)})
+    with open(path, 'w') as f:
+        f.write(SERIES_HEADER.format(name=name, staid=staid, souid=souid))
+        f.writelines('{:6d},{:6d},{},{:5d},{:5d}\n'.format(*row) for row in body.itertuples(index=False))
+
+def daily_series(rng, years=(30, 120), missing=0.05):
+    """(dates, RR in 0.1 mm with -9999 = missing) of one station, ending on LASTDAY"""
+    end = pd.Timestamp(LASTDAY)
+    nyears = int(rng.integers(years[0], years[1]+1))
+    dates = pd.date_range(end-pd.DateOffset(years=nyears)+pd.Timedelta(days=1), end)
+    wet = rng.random(len(dates)) < 0.45
+    rr = np.where(wet, rng.gamma(0.7, 60, len(dates)), 0).astype(int) # 0.1 mm
+    rate = rng.uniform(0, 2*missing) # some stations are much patchier than others
+    gone = rng.random(len(dates)) < rate/2
+    for start in rng.integers(0, len(dates), int(rate*len(dates)/2/60)+1): # and some gaps of ~2 months
+        gone[start:start+60] = True
+    rr[gone] = -9999
+    return dates, rr
+
+def generate(outdir, stations=50, years=(30, 120), missing=0.05, seed=0):
+    """Write the dataset; returns the list of STAIDs ('RR_STAID000001', ...)."""
+    rng = np.random.default_rng(seed)
+    src = os.path.join(outdir, 'data', 'eca_blend_rr')
+    os.makedirs(src, exist_ok=True)
+    os.makedirs(os.path.join(outdir, 'data', 'feather'), exist_ok=True)
+    staids = []
+    with open(os.path.join(src, 'stations.txt'), 'w') as f:
+        f.write(STATIONS_HEADER)
+        for staid in range(1, stations+1):
+            name = 'SYNTHETIC {}'.format(staid)
+            f.write('{:5d},{:<40s},{},{},{},{:4d}\n'.format(
+                staid, name, COUNTRIES[staid % len(COUNTRIES)], dms(rng.uniform(36, 70), 2),
+                dms(rng.uniform(0, 30), 3), int(rng.uniform(0, 1500))))
+            dates, rr = daily_series(rng, years, missing)
+            write_series(os.path.join(src, 'RR_STAID{:06d}.txt'.format(staid)), staid, name, dates, rr)
+            staids.append('RR_STAID{:06d}'.format(staid))
+    return staids
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('outdir')
+    ap.add_argument('--stations', type=int, default=50)
+    ap.add_argument('--years', type=int, nargs=2, default=(30, 120))
+    ap.add_argument('--missing', type=float, default=0.05, help='mean fraction of missing days')
+    ap.add_argument('--seed', type=int, default=0)
+    a = ap.parse_args()
+    generate(a.outdir, a.stations, tuple(a.years), a.missing, a.seed)
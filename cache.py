@@ -0,0 +1,187 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+
+def file_stamp(path):
+    """(mtime, size) of path, used to notice when a cached source file changes. None if missing."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def frame_nbytes(df):
+    return int(df.memory_usage(index=True, deep=False).sum())
+
+
+class LRUCache:
+    """Thread-safe LRU cache of DataFrames bounded by their total size in bytes.
+
+    Each entry remembers the stamp of the file it was computed from; a get with a
+    different stamp drops the entry and counts as a miss.
+    """
+    def __init__(self, maxbytes, sizeof=frame_nbytes):
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()  # key -> (stamp, value, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, stamp):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] != stamp:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, stamp, value):
+        nbytes = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            if nbytes > self.maxbytes:
+                return
+            self._data[key] = (stamp, value, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.maxbytes:
+                self._drop(next(iter(self._data)))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._nbytes = 0
+
+    def info(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._data),
+                        nbytes=self._nbytes, maxbytes=self.maxbytes)
+
+    def _drop(self, key):
+        self._nbytes -= self._data.pop(key)[2]
+
+
+class DiskCache:
+    """LRU cache of DataFrames (as feather files) and bytes in a directory shared by processes.
+
+    The file name hashes the key together with the stamp of the source file, so a changed
+    source is simply never looked up again; such stale entries age out like any other.
+    Files are written to a temporary name and renamed, so readers never see a partial one.
+    A hit touches the file's mtime, and the least recently used files are deleted when the
+    directory grows beyond maxbytes (checked after every maxbytes/EVICT_EVERY written).
+    """
+    EVICT_EVERY = 16
+
+    def __init__(self, directory, maxbytes):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self._written = maxbytes # evict on the first put
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key, stamp, ext):
+        name = hashlib.sha1(repr((key, stamp)).encode()).hexdigest()
+        return os.path.join(self.directory, name+ext)
+
+    def _open(self, path, read):
+        try:
+            value = read(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            value = None # missing, or evicted by another process meanwhile
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def _write(self, path, write):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            write(tmp)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        with self._lock:
+            self._written += size
+            evict = self._written*self.EVICT_EVERY >= self.maxbytes
+            if evict:
+                self._written = 0
+        if evict:
+            self.evict()
+
+    def get_frame(self, key, stamp):
+        """the DataFrame put for key and stamp, None if there is none"""
+        def read(path):
+            df = pd.read_feather(path)
+            return df.set_index(df.columns[0])
+        return self._open(self._path(key, stamp, '.feather'), read)
+
+    def put_frame(self, key, stamp, df):
+        self._write(self._path(key, stamp, '.feather'), df.reset_index().to_feather)
+
+    def get_bytes(self, key, stamp):
+        def read(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        return self._open(self._path(key, stamp, '.bin'), read)
+
+    def put_bytes(self, key, stamp, data):
+        def write(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+        self._write(self._path(key, stamp, '.bin'), write)
+
+    def evict(self):
+        """delete the least recently used files until the directory is within maxbytes"""
+        files = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    if st.st_mtime < time.time()-3600: # left by a killed process
+                        files.append((0, st.st_size, entry.path))
+                    continue
+                files.append((st.st_mtime_ns, st.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        maxbytes, self.maxbytes = self.maxbytes, 0
+        try:
+            self.evict()
+        except FileNotFoundError:
+            pass
+        finally:
+            self.maxbytes = maxbytes
+
+    def info(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, maxbytes=self.maxbytes)
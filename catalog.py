@@ -0,0 +1,86 @@
+"""Station catalog: the stations table indexed both ways (STAID <-> row) with the
+per-station strings the app shows preformatted once at startup, and the temporal
+extent of each series recorded at ingestion."""
+import numpy as np
+
+
+def country_names(codes):
+    """{alpha_3 code: country name} for the distinct codes"""
+    import pycountry
+    names = {}
+    for cn in set(codes):
+        country = pycountry.countries.get(alpha_3=cn)
+        names[cn] = country.name if country else cn
+    return names
+
+
+class StationCatalog:
+    def __init__(self, df):
+        self.df = df
+        self.staids = df['STAID'].tolist() # row -> STAID
+        self.rows = {staid: row for row, staid in enumerate(self.staids)} # STAID -> row
+        self.names = df['STANAME'].tolist()
+        self.labels = df['TXT'].tolist() # legend / dropdown label
+        if 'COUNTRY' in df:
+            self.countries = df['COUNTRY'].tolist()
+        else: # stations.feather written before the COUNTRY column existed
+            names = country_names(df['CN'])
+            self.countries = [names[cn] for cn in df['CN']]
+        self.elevations = ['{:4.0f}'.format(h) for h in df['HGHT']]
+        self.lonlats = ['{:3.2f}/{:3.2f}'.format(lon, lat) for lon, lat in zip(df['LON'], df['LAT'])]
+        # what the dropdown filters its options by as the user types, besides the label
+        self.searches = [' '.join(t) for t in zip(self.names, self.countries, df['CN'], self.staids)]
+        self._searchable = [(text.lower().split(), staid.lstrip('RR_STAID0')) # e.g. '162'
+                            for staid, text in zip(self.staids, self.searches)]
+        if 'FIRST' in df: # None for stations without a recorded extent (stations.feather of older ingestions)
+            self.first_years = [None if d is None or d != d else d.year for d in df['FIRST']]
+            self.last_years = [None if d is None or d != d else d.year for d in df['LAST']]
+            self.complete = df['COMPLETE'].tolist() # see rainproc.series_extent
+        else:
+            self.first_years = self.last_years = self.complete = [None]*len(df)
+
+    def __len__(self):
+        return len(self.staids)
+
+    def row(self, staid):
+        return self.rows[staid]
+
+    def staid(self, row):
+        return self.staids[row]
+
+    def search(self, text, limit=50):
+        """rows (at most limit) of the stations with a word of their name or country (or their
+        STAID number) starting with each word of text"""
+        words = text.lower().split()
+        rows = []
+        for row, (tokens, number) in enumerate(self._searchable):
+            if all(number.startswith(w) or any(t.startswith(w) for t in tokens) for w in words):
+                rows.append(row)
+                if len(rows) == limit:
+                    break
+        return rows
+
+    def extent(self, rows):
+        """(first year, last year) of the series of rows together, None if one has no recorded extent"""
+        if any(self.first_years[r] is None for r in rows):
+            return None
+        return min(self.first_years[r] for r in rows), max(self.last_years[r] for r in rows)
+
+    def incomplete_years(self, rows, start, end):
+        """years from start to end in which at least one of the stations rows fails the
+        completeness rule (or has no data)"""
+        years = np.arange(start, end+1)
+        ok = np.ones(len(years), dtype=bool)
+        for r in rows:
+            bits = np.unpackbits(np.frombuffer(self.complete[r], dtype=np.uint8))
+            i = years-self.first_years[r]
+            inside = (i >= 0) & (i < len(bits))
+            ok &= inside & bits[np.where(inside, i, 0)].astype(bool)
+        return years[~ok].tolist()
+
+    def describe(self, rows):
+        """Station, Country, Elev. and LON/LAT columns of the stats table for the given rows"""
+        return {'Station': [self.names[r] for r in rows],
+                'Country': [self.countries[r] for r in rows],
+                'Elev.': [self.elevations[r] for r in rows],
+                'LON/LAT': [self.lonlats[r] for r in rows]}
@@ -0,0 +1,76 @@
+"""Coalescing and bounding of heavy computations (reading, resampling and fitting station series).
+
+SingleFlight runs a computation once per key at a time: callers asking for a key
+that is already being computed wait for that result instead of repeating it.
+BoundedPool runs computations on a fixed number of threads and refuses new ones
+(Overloaded) when too many are already waiting, so a burst of requests gets a
+quick refusal instead of a growing pile of busy request threads.
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+
+class Overloaded(Exception):
+    """Too many computations queued (or one took too long to start and finish)"""
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {} # key -> Future of the computation in flight
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args):
+        """fn(*args), unless a call for key is in flight: then that call's result (or exception)"""
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return fut.result()
+        try:
+            res = fn(*args)
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(res)
+            return res
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def info(self):
+        with self._lock:
+            return dict(calls=self.calls, shared=self.shared, inflight=len(self._calls))
+
+
+class BoundedPool:
+    def __init__(self, workers, maxqueue, timeout=None):
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='compute')
+        self._slots = threading.BoundedSemaphore(workers+maxqueue) # running + waiting
+        self.refused = 0
+
+    def run(self, fn, *args):
+        """fn(*args) on a pool thread; raises Overloaded if the queue is full or the result
+        does not come within timeout (the computation then still finishes in the background)"""
+        if not self._slots.acquire(blocking=False):
+            self.refused += 1
+            raise Overloaded()
+        try:
+            fut = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        fut.add_done_callback(lambda f: self._slots.release())
+        try:
+            return fut.result(self.timeout)
+        except TimeoutError:
+            self.refused += 1
+            raise Overloaded()
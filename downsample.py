@@ -0,0 +1,35 @@
+"""Point reduction for plotting long series (e.g. a century of daily rainfall)."""
+import numpy as np
+
+
+def minmax_indices(y, nbuckets):
+    """Sorted indices of the min and max of y in each of nbuckets equal buckets, so peaks survive.
+    NaNs are ignored; an all-NaN bucket keeps its first index, so the plotted line shows the gap."""
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= 2*nbuckets:
+        return np.arange(n)
+    k = -(-n//nbuckets) # bucket size, rounded up
+    nbuckets = -(-n//k)
+    pad = np.full(nbuckets*k, np.nan)
+    pad[:n] = y
+    pad = pad.reshape(nbuckets, k)
+    nan = np.isnan(pad)
+    start = np.arange(nbuckets)*k
+    imax = start+np.where(nan, -np.inf, pad).argmax(axis=1)
+    imin = start+np.where(nan, np.inf, pad).argmin(axis=1)
+    empty = nan.all(axis=1)
+    imax[empty] = imin[empty] = start[empty]
+    return np.unique(np.concatenate([imin, imax]))
+
+def view_indices(x, y, npoints, xrange=None):
+    """Indices of at most about npoints of (x, y) to plot: a coarse min-max overview of the whole
+    series (for the range slider) plus a dense one of the visible xrange=(x0, x1), x sorted."""
+    if len(y) <= npoints:
+        return np.arange(len(y))
+    if xrange is None:
+        return minmax_indices(y, npoints//2)
+    i0, i1 = np.searchsorted(x, xrange[0]), np.searchsorted(x, xrange[1], side='right')
+    overview = minmax_indices(y, npoints//8)
+    visible = i0+minmax_indices(y[i0:i1], npoints*3//8)
+    return np.union1d(overview, visible)
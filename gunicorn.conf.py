@@ -0,0 +1,31 @@
+import glob
+import os
+import tempfile
+
+# build the Dash app once in the master; forked workers share its memory (copy on write)
+preload_app = True
+
+# requests of a worker are served by threads, so identical ones can share a computation
+# and heavy ones queue on the app's compute pool (see compute.py)
+threads = 8
+
+# each worker writes its metrics here and /metrics adds them up, see metrics.py
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'rainfall-metrics'))
+
+def on_starting(server):
+    """Start the metrics of a new master from zero"""
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+def when_ready(server):
+    """Import in the master what rainproc/app import lazily, so workers do not each pay it on their first request"""
+    import scipy.special
+    import scipy.spatial # see spatial.StationIndex.tree
+    import pycountry
+    pycountry.countries.get(alpha_3='NLD') # loads the country database
+
+def child_exit(server, worker):
+    """Keep the counts of an exited worker, out of the way of a new worker with the same pid"""
+    path = os.path.join(os.environ['METRICS_DIR'], '{}.json'.format(worker.pid))
+    if os.path.exists(path):
+        os.replace(path, os.path.join(os.environ['METRICS_DIR'], 'exited-{}-{}.json'.format(worker.pid, os.urandom(4).hex())))
@@ -0,0 +1,152 @@
+"""Counters and histograms in the Prometheus text format, without a metrics server.
+
+Each process records into REGISTRY. If METRICS_DIR is set (gunicorn.conf.py does),
+every process also dumps a snapshot to METRICS_DIR/<pid>.json at most once per
+DUMP_INTERVAL seconds, and render() merges all snapshots in the directory, so a
+scrape of any worker reports the totals of all of them.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+SECONDS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+BYTES = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+DUMP_INTERVAL = 1.0
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+class Registry:
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._meta = {} # name -> (type, help, buckets)
+        self._counters = {} # (name, labels) -> value
+        self._hists = {} # (name, labels) -> [cumulative bucket counts..., sum, count]
+        self._collectors = []
+        self._dumped = 0
+
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=SECONDS):
+        self._meta[name] = ('histogram', help, buckets)
+
+    def add_collector(self, fn):
+        """fn() -> [(counter name, labels dict, value)], for totals kept elsewhere (e.g. cache hits)"""
+        self._collectors.append(fn)
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0)+value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = _key(name, labels)
+        with self._lock:
+            h = self._hists.setdefault(key, [0]*(len(buckets)+2))
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter()-t, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            hists = {k: list(v) for k, v in self._hists.items()}
+        for fn in self._collectors:
+            for name, labels, value in fn():
+                counters[_key(name, labels)] = value
+        return dict(counters=[[n, dict(l), v] for (n, l), v in counters.items()],
+                    hists=[[n, dict(l), v] for (n, l), v in hists.items()])
+
+    def dump(self, force=False):
+        """write this process' snapshot to the directory (if any), at most once per DUMP_INTERVAL"""
+        if not self.directory or (not force and time.monotonic()-self._dumped < DUMP_INTERVAL):
+            return
+        self._dumped = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        tmp = path+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def _snapshots(self):
+        if not self.directory:
+            return [self.snapshot()]
+        self.dump(force=True)
+        snaps = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snaps.append(json.load(f))
+            except (OSError, ValueError):
+                pass # a worker is rewriting it
+        return snaps
+
+    def render(self):
+        """all processes' metrics in the Prometheus text exposition format"""
+        counters, hists = {}, {}
+        for snap in self._snapshots():
+            for name, labels, value in snap['counters']:
+                key = _key(name, labels)
+                counters[key] = counters.get(key, 0)+value
+            for name, labels, value in snap['hists']:
+                key = _key(name, labels)
+                hists[key] = [a+b for a, b in zip(hists[key], value)] if key in hists else value
+        lines = []
+        for name, (typ, help, buckets) in sorted(self._meta.items()):
+            lines += ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, typ)]
+            if typ == 'counter':
+                lines += ['{}{} {}'.format(name, _labels(l), v) for (n, l), v in sorted(counters.items()) if n == name]
+                continue
+            for (n, l), h in sorted(hists.items()):
+                if n != name:
+                    continue
+                for le, count in zip(buckets, h):
+                    lines.append('{}_bucket{} {}'.format(name, _labels(l+(('le', repr(float(le))),)), count))
+                lines += ['{}_bucket{} {}'.format(name, _labels(l+(('le', '+Inf'),)), h[-1]),
+                          '{}_sum{} {}'.format(name, _labels(l), h[-2]),
+                          '{}_count{} {}'.format(name, _labels(l), h[-1])]
+        return '\n'.join(lines)+'\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    esc = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{'+','.join('{}="{}"'.format(k, esc(v)) for k, v in labels)+'}'
+
+
+REGISTRY = Registry(os.environ.get('METRICS_DIR'))
+REGISTRY.histogram('rainfall_stage_seconds', 'Time spent in a processing stage (read, resample, fit, figure, serialize)')
+REGISTRY.counter('rainfall_cache_hits_total', 'Cache lookups answered from memory')
+REGISTRY.counter('rainfall_cache_misses_total', 'Cache lookups that had to compute')
+
+def stage(name, freq=''):
+    """context manager timing a processing stage"""
+    return REGISTRY.time('rainfall_stage_seconds', stage=name, freq=freq)
+
+def cache_counters(name, cache):
+    """collector of the hit/miss counters of a cache.LRUCache"""
+    def collect():
+        info = cache.info()
+        return [('rainfall_cache_hits_total', dict(cache=name), info['hits']),
+                ('rainfall_cache_misses_total', dict(cache=name), info['misses'])]
+    return collect
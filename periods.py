@@ -0,0 +1,133 @@
+"""Period types (the freq of a resampled series) and their buckets, computed from daily data.
+
+A period type maps every day to an integer bucket code: the day itself (24H), its week
+(WE, Monday to Sunday), or for the month based types the number of windows of `step` months
+since the window starting in January 1970, leaving out the days outside the window's first
+`length` months (single seasons and custom windows). summarise sums the daily data per calendar
+month once and rolls all month based types up from those months. A bucket's TOTAL or MAX is
+kept where more than COMPLETE of its calendar days have a value, and it is labelled with its
+last day, as pandas' resample labels 'YE' and 'ME'.
+"""
+import calendar
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+COMPLETE = .9 # fraction of a bucket's days that must be valid
+HYDRO_START = 10 # first month of the hydrological year
+
+Months = namedtuple('Months', 'start length step') # buckets of the `length` months from `start`, every `step` months
+Period = namedtuple('Period', 'label months freq') # months is None for the day based types; freq: pandas' name
+
+def _year_end(month):
+    return 'YE-'+calendar.month_abbr[month].upper()
+
+def _window(first, last):
+    """Months of first to last (wrapping around the new year) every year"""
+    return Months(first, (last-first) % 12+1, 12)
+
+_HYDRO_END = (HYDRO_START-2) % 12+1
+PERIODS = {
+    'YE': Period('Yearly', Months(1, 12, 12), 'YE'),
+    'HYE': Period('Hydrological years ({}-{})'.format(calendar.month_abbr[HYDRO_START], calendar.month_abbr[_HYDRO_END]),
+                  Months(HYDRO_START, 12, 12), _year_end(_HYDRO_END)),
+    'SEASON': Period('Seasons (DJF, MAM, JJA, SON)', Months(12, 3, 3), 'QE-FEB'),
+    'DJF': Period('Winters (DJF)', _window(12, 2), 'YE-FEB'),
+    'MAM': Period('Springs (MAM)', _window(3, 5), 'YE-MAY'),
+    'JJA': Period('Summers (JJA)', _window(6, 8), 'YE-AUG'),
+    'SON': Period('Autumns (SON)', _window(9, 11), 'YE-NOV'),
+    'QE': Period('Quarterly', Months(1, 3, 3), 'QE'),
+    'ME': Period('Monthly', Months(1, 1, 1), 'ME'),
+    'WE': Period('Weekly', None, 'W-SUN'),
+    '24H': Period('Daily', None, '24h'),
+}
+ALIASES = {'Y': 'YE', 'A': 'YE', 'Q': 'QE', 'M': 'ME', 'W': 'WE', 'D': '24H'} # pandas' older names
+CUSTOM = re.compile(r'M(\d{1,2})-(\d{1,2})') # e.g. 'M5-9': May to September of every year
+
+
+def period(freq):
+    """the Period of freq: a PERIODS key or a custom window CUSTOM. KeyError if it is neither."""
+    if freq in PERIODS:
+        return PERIODS[freq]
+    m = CUSTOM.fullmatch(freq) if isinstance(freq, str) else None
+    first, last = (int(m[1]), int(m[2])) if m else (0, 0)
+    if not (1 <= first <= 12 and 1 <= last <= 12):
+        raise KeyError(freq)
+    return Period('{}-{}'.format(calendar.month_abbr[first], calendar.month_abbr[last]), _window(first, last), _year_end(last))
+
+def canonical(freq):
+    """the name resampled and its caches use for freq (see ALIASES); KeyError if unknown"""
+    freq = ALIASES.get(freq, freq)
+    period(freq)
+    return freq
+
+def day_numbers(dates):
+    """days since 1970-01-01 of dates"""
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+
+def _months(days):
+    """months since 1970-01 of days"""
+    return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+def _month_days(months):
+    return months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+
+def _month_codes(months, window):
+    rel = months-(window.start-1)
+    return rel//window.step, rel % window.step < window.length
+
+def codes(days, freq):
+    """(bucket code, whether it is in a bucket at all) of every day"""
+    window = period(freq).months
+    if window is None:
+        return days if freq == '24H' else (days+3)//7, np.ones(len(days), dtype=bool)
+    return _month_codes(_months(days), window)
+
+def bounds(code, freq):
+    """(first day, day after the last day) of buckets"""
+    window = period(freq).months
+    if window is None:
+        return (code, code+1) if freq == '24H' else (7*code-3, 7*code+4)
+    first = code*window.step+window.start-1
+    return _month_days(first), _month_days(first+window.length)
+
+def labels(code, freq):
+    """DatetimeIndex of the last days of buckets, with the freq pandas knows the period type by"""
+    return pd.DatetimeIndex((bounds(code, freq)[1]-1).astype('datetime64[D]'), dtype='datetime64[ns]', name='Date', freq=period(freq).freq)
+
+def _reduce(code, total, count, maxv):
+    """sum, count and maximum per run of equal codes"""
+    if not len(code):
+        return code, total, count, maxv
+    starts = np.flatnonzero(np.r_[True, code[1:] != code[:-1]])
+    return (code[starts], np.add.reduceat(total, starts), np.add.reduceat(count, starts),
+            np.fmax.reduceat(maxv, starts))
+
+def summarise(days, values, freqs):
+    """{freq: frame of TOTAL and MAX per bucket} of the daily values on days (increasing day
+    numbers), for every bucket from the one of the first day to the one of the last"""
+    days, values = np.asarray(days, dtype=np.int64), np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    daily = (np.where(valid, values, 0), valid.astype(np.int64), values)
+    monthly = None
+    res = {}
+    for freq in freqs:
+        if period(freq).months is None:
+            code, inside = codes(days, freq)
+            table = daily
+        else:
+            if monthly is None: # one pass over the days for all month based types
+                monthly = _reduce(_months(days), *daily)
+            code, inside = _month_codes(monthly[0], period(freq).months)
+            table = monthly[1:]
+        code, total, count, maxv = _reduce(code[inside], *(column[inside] for column in table))
+        full = np.arange(code[0], code[-1]+1) if len(code) else code
+        at = code-full[0] if len(code) else code
+        first, stop = bounds(full, freq)
+        complete = count > COMPLETE*(stop-first)[at]
+        frame = {'TOTAL': np.full(len(full), np.nan), 'MAX': np.full(len(full), np.nan)}
+        frame['TOTAL'][at[complete]], frame['MAX'][at[complete]] = total[complete], maxv[complete]
+        res[freq] = pd.DataFrame(frame, index=labels(full, freq))
+    return res
@@ -1,13 +1,19 @@
-import chardet
 import pandas as pd
-import pycountry
 import numpy as np
-import statsmodels.formula.api as smf
-import requests
-import io
+import os
+import sys
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from cache import LRUCache, DiskCache, file_stamp
+from store import FeatherStore, ArrowStore, DailyMatrix, write_versioned, file_version
+from trend import ols_trend, mann_kendall, sen_slope
+import regional
+import periods
+from catalog import country_names
+from metrics import REGISTRY, stage, cache_counters
+from compute import SingleFlight
 
-notmissingthres = {"YE":365*.9, "ME":30*.9, "WE":7*.9, "Q":365/4*.9, "24H":.9}
 
 USEONLINE=True
 
@@ -15,6 +21,15 @@ USEONLINE=True
 #station_store_online = 'http://data.pathirana.net/feather/stations.feather'    
 feather_store = './data/feather/STN{}'
 station_store = './data/feather/stations.feather'
+aggregate_store = './data/feather/AGG{}_{}' # staid, freq. Columns: Date, TOTAL, MAX
+rain_csv = './data/eca_blend_rr/{}.txt'
+manifest_store = './data/feather/manifest.feather' # source file signature and stats per station, see pre_process
+arrow_store = './data/feather/rainfall.arrow' # all stations in one memory-mapped file, see store.ArrowStore
+matrix_store = './data/feather/daily.npy' # all stations x days on one calendar, see store.DailyMatrix (daily.npy.json names the file)
+trend_store = './data/feather/trends.feather' # slope and p-value of every station, freq and summ, see write_trend_atlas
+DAILY_STORE = os.environ.get('RAINFALL_STORE', 'feather') # 'feather' or 'arrow': where resampled reads daily series
+INGEST_WORKERS = None # processes used by pre_process, None = one per core
+ECA_SAMPLE = 4096 # bytes read to guess the encoding and find the header of an ECA&D file
 
 #COMPRESS = 'blosc:snappy'
 #COMPRESS = 'bzip2'
@@ -25,6 +40,32 @@ COMPLEVEVL = 9
 COMP=dict(complib=COMPRESS, complevel=COMPLEVEVL, format='table',  )
 TOTAL=1
 MAX = 2
+SUMMCOLS = {TOTAL:'TOTAL', MAX:'MAX'}
+AGGREGATE_FREQS = ('YE', 'ME') # precomputed by pre_process, served without touching daily data
+TREND_FREQS = tuple(periods.PERIODS) # fitted for every station (see write_trend_atlas), so the map can color by any of them
+TREND_CELLS = 2*1024**2 # stations x periods fitted in one ols_trend call
+TREND_STATIONS = 64 # stations read and fitted per task when write_trend_atlas fits stations itself
+REGION_ROWS = 256 # stations read from daily_matrix at once by regional_series
+TREND_METHODS = ('ols', 'sen') # see trend_fits
+
+station_files = FeatherStore(feather_store) # always written by ingestion
+daily_store = ArrowStore(arrow_store) if DAILY_STORE == 'arrow' else station_files
+daily_matrix = DailyMatrix(matrix_store)
+
+CACHE_MAXBYTES = 64*1024**2 # resampled series kept in memory per process
+resample_cache = LRUCache(CACHE_MAXBYTES) # see resample_cache.info() for hit/miss counters
+REGISTRY.add_collector(cache_counters('resampled', resample_cache))
+resample_flights = SingleFlight() # concurrent misses of one series compute it once
+TREND_CACHE_ENTRIES = 4096
+trend_cache = LRUCache(TREND_CACHE_ENTRIES, sizeof=lambda fit: 1) # fits of station_trends, bounded by their number
+REGISTRY.add_collector(cache_counters('trend', trend_cache))
+CACHE_DIR = os.environ.get('RAINFALL_CACHE_DIR', './data/cache') # shared by all processes, '' to disable
+CACHE_VERSION = 2 # part of every disk cache key: bump when the same source gives other series or charts
+RULES_VERSION = '2' # of periods.py's completeness rule, written into aggregate files and the trend atlas; others are not used
+DISK_CACHE_MAXBYTES = 1024**3
+disk_cache = DiskCache(CACHE_DIR, DISK_CACHE_MAXBYTES) if CACHE_DIR else None
+if disk_cache:
+    REGISTRY.add_collector(cache_counters('disk', disk_cache))
 
 def auto_tick(data_range, max_tick=10, tf_inside=False):
     """
@@ -52,37 +93,220 @@ def auto_tick(data_range, max_tick=10, tf_inside=False):
     return ticks
 
 def read_rain_from_csv(file):
-    tomm= lambda x: np.NaN if float(x) < 0 else 0.1*float(x) # negative values = missing data
+    """Parse an ECA&D blended series file (RR_STAID*.txt) into Date and Rainfall_mm (mm, NaN = missing) columns."""
+    encoding, skip = _eca_header(file)
+    df = pd.read_csv(file, encoding=encoding, skiprows=skip, header=0, usecols=[2,3], names=["Date", "RR"],
+                     dtype={"Date":str, "RR":np.int32}, engine='c')
+    rr = df["RR"].to_numpy(dtype=float)
+    rr[rr < 0] = np.nan # negative values (-9999) = missing data
+    return pd.DataFrame({"Date": pd.to_datetime(df["Date"], format="%Y%m%d"), "Rainfall_mm": 0.1*rr})
+
+def _eca_header(file, sample=ECA_SAMPLE):
+    """Encoding (guessed from the first `sample` bytes) and line number of the 'STAID, SOUID, DATE, ...' header"""
+    import chardet # only needed for ingestion, keep it out of the app's startup
     with open(file,'rb') as f:
-        data = f.read()  # or a chunk, f.read(1000000)
-    encoding=chardet.detect(data).get("encoding")
-    
-    df = pd.read_csv(file, encoding=encoding, names=["Date", "Rainfall_mm"], index_col="Date", usecols=[2,3], header=15, parse_dates=['Date'], converters={'Rainfall_mm':tomm})
-    df.replace(-9999, np.nan, inplace=True)
-    return df.reset_index()
+        data = f.read(sample)
+    encoding=chardet.detect(data).get("encoding") or 'latin-1'
+    for num, line in enumerate(data.decode(encoding, errors='replace').splitlines()):
+        if line.lstrip().startswith('STAID') and 'DATE' in line:
+            return encoding, num
+    raise ValueError("No ECA&D header line found in {}".format(file))
 
+def read_rain_HDF(hdfstore, name, file):
+    hdfstore.put(name, read_rain_from_csv(file).set_index('Date'), **COMP)
 
+def rainfallcsv2feather(workers=INGEST_WORKERS, stnids=None):
+    """Ingest station files (all stations if stnids is None) across a process pool of `workers` (None = one per core).
+    Returns ({STAID: manifest entry}, {STAID: error}, {STAID: trend atlas row}) for the stations that
+    succeeded/failed and the trends of those that succeeded."""
+    if stnids is None:
+        stnids = pd.read_feather(station_store, columns=['STAID'])['STAID']
+    stats, errors, fits = {}, {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(ingest_station, stnid): stnid for stnid in stnids}
+        for ct, fut in enumerate(as_completed(futures), 1):
+            stnid = futures[fut]
+            try:
+                stats[stnid], fits[stnid] = fut.result()
+                print('[{}/{}] {} m={:.3%}'.format(ct, len(futures), stnid, stats[stnid]['MISSING']), file=sys.stderr)
+            except Exception as e:
+                errors[stnid] = e
+                print('[{}/{}] {} failed: {}'.format(ct, len(futures), stnid, e), file=sys.stderr)
+    return stats, errors, fits
 
-def read_rain_HDF(hdfstore, name, file):
-    tomm= lambda x: np.NaN if float(x) < 0 else 0.1*float(x) # negative values = missing data
-    df = pd.read_csv(file, names=["Date", "Rainfall_mm"], index_col="Date", usecols=[2,3], header=16, parse_dates=['Date'], converters={3:tomm})
-    df.replace(-9999, np.nan, inplace=True)
-    hdfstore.put(name,df, **COMP)
+def ingest_station(stnid):
+    """Parse one RR_STAID file once: write its feather and aggregate files and return its manifest entry
+    (source file signature plus LENGTH, MISSING and the series_extent columns) and its trend atlas row."""
+    file=rain_csv.format(stnid)
+    entry=source_signature(file) # taken before parsing, so a file changed meanwhile is picked up next time
+    df=read_rain_from_csv(file)
+    station_files.write(stnid, df)
+    write_aggregates(stnid, df.set_index('Date'))
+    entry['LENGTH'], entry['MISSING'] = series_stats(df)
+    entry.update(series_extent(df))
+    return entry, fit_trends({stnid: trend_series(df.set_index('Date'))})[stnid]
+
+def source_signature(file):
+    """SIZE, MTIME and content HASH of a source file"""
+    st = os.stat(file)
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024**2), b''):
+            h.update(chunk)
+    return dict(SIZE=st.st_size, MTIME=st.st_mtime_ns, HASH=h.hexdigest())
+
+def read_manifest():
+    """{STAID: manifest entry} of the last ingestion, empty if there is none"""
+    try:
+        return pd.read_feather(manifest_store).set_index('STAID').to_dict(orient='index')
+    except OSError:
+        return {}
+
+def write_manifest(entries):
+    pd.DataFrame.from_dict(entries, orient='index').rename_axis('STAID').reset_index().to_feather(manifest_store)
+
+def changed_stations(stnids, manifest):
+    """Split stnids into a list of stations whose source file is new or changed (or whose aggregate
+    files are not current), and the manifest entries of the unchanged ones. Files are only hashed
+    when their size or mtime moved."""
+    changed, kept = [], {}
+    for stnid in stnids:
+        old = manifest.get(stnid)
+        file = rain_csv.format(stnid)
+        try:
+            st = os.stat(file)
+        except OSError:
+            changed.append(stnid) # let ingestion report it
+            continue
+        if old is None or station_files.stamp(stnid) is None:
+            changed.append(stnid)
+        elif not all(_aggregate_file(stnid, freq) for freq in AGGREGATE_FREQS):
+            changed.append(stnid) # missing, or written under other rules
+        elif (st.st_size, st.st_mtime_ns) == (old['SIZE'], old['MTIME']):
+            kept[stnid] = old
+        elif st.st_size == old['SIZE'] and source_signature(file)['HASH'] == old['HASH']:
+            kept[stnid] = dict(old, MTIME=st.st_mtime_ns) # touched, same content
+        else:
+            changed.append(stnid)
+    return changed, kept
+
+def remove_station(stnid):
+    """Delete the feather and aggregate files of a station that is no longer in the source data"""
+    station_files.remove(stnid)
+    for fs in [aggregate_store.format(stnid, freq) for freq in AGGREGATE_FREQS]:
+        try:
+            os.remove(fs)
+        except FileNotFoundError:
+            pass
+
+def series_stats(df):
+    """(length in years, missing fraction) of a daily series"""
+    n = df['Rainfall_mm'].shape[0]
+    return n/360., df['Rainfall_mm'].isnull().sum()/n  # length converted to years.
 
-def rainfallcsv2feather():
+def series_extent(df):
+    """FIRST and LAST date of a daily series, and COMPLETE: a bitmap (np.packbits) of its years
+    from the first one on, set where the year is complete (see periods.COMPLETE)"""
+    complete = resample_data(df.set_index('Date'), 'YE', TOTAL)['Rainfall_mm'].notna().to_numpy()
+    return dict(FIRST=df['Date'].iloc[0], LAST=df['Date'].iloc[-1], COMPLETE=np.packbits(complete).tobytes())
+
+def write_aggregates(staid, data):
+    """Write the AGGREGATE_FREQS TOTAL/MAX series (completeness mask applied) of a Date-indexed daily frame,
+    all summarised in one pass."""
+    aggs = periods.summarise(periods.day_numbers(data.index), data['Rainfall_mm'], AGGREGATE_FREQS)
+    for freq, agg in aggs.items():
+        write_versioned(agg.reset_index(), aggregate_store.format(staid, freq), RULES_VERSION)
+
+def feather2aggregates():
+    """(Re)build the aggregate tier from existing STN feather files, e.g. for stores made before it existed."""
     stns = pd.read_feather(station_store, columns=['STAID'])
-    ct=0
-    for index, s in stns.iterrows():
-        stnid=s['STAID']
-        fs=feather_store.format(stnid)
-        read_rain_from_csv( './data/eca_blend_rr/{}.txt'.format(stnid)).to_feather(fs)
-        ct+=1
-        #if (ct>10): break;
-        
-        
-def resampled(staid,freq, summ):
+    for stnid in stns['STAID']:
+        write_aggregates(stnid, station_files.read(stnid).set_index('Date'))
+
+def _aggregate_file(staid, freq):
+    """The precomputed aggregate file for freq if there is one at least as new as the station's daily
+    file, written under RULES_VERSION"""
+    if freq in AGGREGATE_FREQS:
+        agg = aggregate_store.format(staid, freq)
+        astamp, dstamp = file_stamp(agg), station_files.stamp(staid)
+        if astamp and (dstamp is None or astamp[0] >= dstamp[0]) and _current(agg, astamp):
+            return agg
+    return None
+
+_current_files = {} # path: stamp of the aggregate files found to be of RULES_VERSION
+
+def _current(path, stamp):
+    """whether the feather file path (at stamp) was written under RULES_VERSION"""
+    if _current_files.get(path) != stamp:
+        try:
+            if file_version(path) != RULES_VERSION:
+                return False
+        except (OSError, ValueError): # e.g. not an Arrow file
+            return False
+        _current_files[path] = stamp
+    return True
+
+def resampled(staid, freq, summ, trange=None):
+    """Resampled series of a station, memoized in resample_cache until its source file changes.
+    With trange=[start, end] (years) only the buckets labelled from start-01-01 to (end+1)-01-01
+    are returned, and only the daily rows they need are read.
+    freq is a periods.PERIODS key, a custom window or one of periods.ALIASES (KeyError otherwise).
+    Returns a copy, so callers are free to modify it."""
+    freq = periods.canonical(freq)
+    agg, stamp = _source(staid, freq)
+    key = (staid, freq, summ) + (tuple(trange) if trange else ())
+    data = resample_cache.get(key, stamp)
+    if data is None:
+        data = resample_flights.do(key+(stamp,), _resampled_into_cache, key, stamp, agg)
+        if data is None:
+            return None # error
+    return data.copy()
+
+def range_labels(trange):
+    """first and last bucket label (both included) of the years trange=[start, end]"""
+    return pd.Timestamp(trange[0], 1, 1), pd.Timestamp(trange[1]+1, 1, 1)
+
+def _read_window(freq, trange):
+    """dates [start, stop) of the daily rows in the buckets labelled within trange, give or take a bucket"""
+    first, last = range_labels(trange)
+    step = pd.tseries.frequencies.to_offset(periods.period(freq).freq)
+    return first-step, last+step
+
+def _source(staid, freq):
+    """(aggregate file or None, stamp of the file) resampled reads for staid and freq"""
+    agg = _aggregate_file(staid, freq)
+    return agg, file_stamp(agg) if agg else daily_store.stamp(staid)
+
+def series_stamp(staid, freq):
+    """changes whenever resampled(staid, freq, ...) may change"""
+    return _source(staid, periods.canonical(freq))[1]
+
+def _resampled_into_cache(key, stamp, agg):
+    """_resampled, through disk_cache unless it reads a (precomputed) aggregate file anyway"""
+    shared = disk_cache if not agg else None
+    data = shared.get_frame((CACHE_VERSION,)+key, stamp) if shared else None
+    if data is not None:
+        data.index = pd.DatetimeIndex(data.index, freq=periods.period(key[1]).freq) # feather does not keep the index freq
+    else:
+        data = _resampled(*key[:3], agg, key[3:])
+        if data is not None and shared:
+            shared.put_frame((CACHE_VERSION,)+key, stamp, data)
+    if data is not None:
+        resample_cache.put(key, stamp, data)
+    return data
+
+def _resampled(staid,freq, summ, agg=None, trange=None):
+    if summ not in SUMMCOLS:
+        return None # error
+    if agg:
+        with stage('read', freq):
+            data = pd.read_feather(agg, columns=['Date', SUMMCOLS[summ]])
+        data = data.set_index('Date').rename(columns={SUMMCOLS[summ]:'Rainfall_mm'})
+        data.index = pd.DatetimeIndex(data.index, freq=periods.period(freq).freq) # feather does not keep the index freq
+        return data[slice(*range_labels(trange))] if trange else data
     #try:
-    data = pd.read_feather(feather_store.format(staid))
+    with stage('read', freq):
+        data = daily_store.read(staid, *_read_window(freq, trange)) if trange else daily_store.read(staid)
     #except:
     #    response = requests.get(feather_store_online.format(staid))
     #    
@@ -91,23 +315,195 @@ def resampled(staid,freq, summ):
 
     # set the index to Date
     data.set_index('Date', inplace=True)
-    
-    if summ==TOTAL:
-        return data.resample(freq).apply(lambda x: 
-                                 x.sum(skipna=True) if x.notnull().sum() > notmissingthres[freq] 
-                                 else np.NaN)
-    if summ==MAX:
-        return data.resample(freq).apply(lambda x: 
-                                         x.max(skipna=True) if x.notnull().sum() > notmissingthres[freq] 
-                                     else np.NaN)        
-    return None # error   
-
-def linear_fit(data, xcol='ndates', ycol='Rainfall_mm'):
-    data['ndates'] = (data.index-pd.to_datetime('1800-01-01')).days
-    ft=smf.ols( '{} ~ {}'.format(ycol,xcol), data=data, missing='drop' ).fit()
-    return ft.params.ndates*data.ndates+ft.params.Intercept, ft.pvalues.ndates, ft.params.ndates
+
+    with stage('resample', freq):
+        data = resample_data(data, freq, summ)
+    # the buckets at the ends of a read window are incomplete, and outside trange
+    return data[slice(*range_labels(trange))] if trange else data
+
+def regional_series(staids, lon, lat, freq, summ, trange=None, weighting='mean'):
+    """Weighted mean TOTAL or MAX series of the stations staids at lon, lat (see regional.py) as a
+    frame of Rainfall_mm and STATIONS (the number averaged) per bucket, trange as in resampled.
+    Computed from daily_matrix, REGION_ROWS stations at a time, or from resampled without one."""
+    if summ not in SUMMCOLS:
+        return None # error
+    freq = periods.canonical(freq)
+    weights = regional.station_weights(lon, lat, weighting)
+    start, stop = _read_window(freq, trange) if trange else (None, None)
+    try:
+        first, ndays = daily_matrix.window(start, stop)
+        labels, columns, starts, days = regional.buckets(first, ndays, freq)
+        mean = regional.RegionalMean(len(starts))
+        for i in range(0, len(staids) if len(starts) else 0, REGION_ROWS):
+            with stage('read', freq):
+                X = daily_matrix.read(staids[i:i+REGION_ROWS], start, stop)[:, columns]
+            with stage('resample', freq):
+                mean.add(regional.station_buckets(X, starts, SUMMCOLS[summ], periods.COMPLETE*days),
+                         weights[i:i+REGION_ROWS])
+    except FileNotFoundError: # no matrix, or stations missing from it
+        series = [resampled(staid, freq, summ, trange)['Rainfall_mm'] for staid in staids]
+        values = pd.concat(series, axis=1) if series else pd.DataFrame(index=pd.DatetimeIndex([], name='Date'))
+        values = values.asfreq(periods.period(freq).freq)
+        labels, mean = values.index, regional.RegionalMean(len(values))
+        mean.add(values.to_numpy().T, weights)
+    value, n = mean.result()
+    data = pd.DataFrame({'Rainfall_mm': value, 'STATIONS': n},
+                        index=pd.DatetimeIndex(labels, name='Date', freq=periods.period(freq).freq))
+    some = np.flatnonzero(n) # leave out the calendar before and after all of the stations' data
+    data = data.iloc[some[0]:some[-1]+1] if len(some) else data.iloc[:0]
+    return data[slice(*range_labels(trange))] if trange else data
+
+def write_daily_matrix(changed=None):
+    """(Re)build daily_matrix from the feather files of the stations with a recorded extent. Given
+    the stations whose files changed, only their rows are rewritten when the stations and calendar
+    are those of the current matrix (see DailyMatrix.build)."""
+    stns = pd.read_feather(station_store, columns=['STAID', 'FIRST', 'LAST']).dropna()
+    if len(stns):
+        daily_matrix.build(station_files, stns['STAID'].tolist(), stns['FIRST'].min(), stns['LAST'].max(), changed)
+
+def resample_data(data, freq, summ):
+    """Summarise a Date-indexed rainfall frame per freq bucket (see periods.summarise).
+    Buckets with too few valid days (see periods.COMPLETE) are set to NaN."""
+    if summ not in (TOTAL, MAX):
+        return None # error
+    agg = periods.summarise(periods.day_numbers(data.index), data['Rainfall_mm'], [freq])[freq]
+    return agg[[SUMMCOLS[summ]]].rename(columns={SUMMCOLS[summ]: 'Rainfall_mm'})
+
+def ndates(index):
+    """days since 1800-01-01, the x used for trends"""
+    return (index-pd.to_datetime('1800-01-01')).days.to_numpy()
+
+def linear_fit(data, ycol='Rainfall_mm'):
+    """OLS trend of data[ycol] against time: (fitted line, p-value, slope in units per day). data is not modified."""
+    x = ndates(data.index)
+    slope, intercept, pval = ols_trend(x, data[ycol].to_numpy())
+    return pd.Series(slope[0]*x+intercept[0], index=data.index), pval[0], slope[0]
+
+def trend_fits(frames, method='ols', ycol='Rainfall_mm'):
+    """(fitted line, p-value, slope in units per day) of each Date-indexed frame, all fitted in one call:
+    'ols' as linear_fit, 'sen' the Theil-Sen line with the Mann-Kendall p-value (trend.py).
+    Frames with fewer than two values get a NaN line and slope and a p-value of 1."""
+    if not frames:
+        return []
+    width = max(len(data) for data in frames)
+    X, Y = np.zeros((len(frames), width)), np.full((len(frames), width), np.nan)
+    for i, data in enumerate(frames):
+        X[i, :len(data)] = ndates(data.index)
+        Y[i, :len(data)] = data[ycol].to_numpy()
+    if method == 'sen':
+        slope, intercept = sen_slope(X, Y)
+        pval = mann_kendall(Y)[1]
+    else:
+        slope, intercept, pval = ols_trend(X, Y)
+    fits = []
+    for i, data in enumerate(frames):
+        if data[ycol].count() < 2:
+            fits.append((pd.Series(np.nan, index=data.index), 1.0, np.nan))
+        else:
+            fits.append((pd.Series(slope[i]*X[i, :len(data)]+intercept[i], index=data.index),
+                         1.0 if np.isnan(pval[i]) else pval[i], slope[i]))
+    return fits
+
+def station_trends(staids, frames, freq, summ, trange=None, method='ols'):
+    """trend_fits of the frames resampled(staid, freq, summ, trange) of the stations staids, memoized
+    per station in trend_cache until its source changes; the misses are fitted together"""
+    keys = [('trend', method, staid, freq, summ)+(tuple(trange) if trange else ()) for staid in staids]
+    stamps = [series_stamp(staid, freq) for staid in staids]
+    fits = [trend_cache.get(key, stamp) for key, stamp in zip(keys, stamps)]
+    missing = [i for i, fit in enumerate(fits) if fit is None]
+    with stage('fit', freq):
+        for i, fit in zip(missing, trend_fits([frames[i] for i in missing], method)):
+            trend_cache.put(keys[i], stamps[i], fit)
+            fits[i] = fit
+    return fits
+
+def trend_series(data):
+    """{freq: TOTAL/MAX frame} of each of TREND_FREQS of a Date-indexed daily frame, as resampled computes them"""
+    return periods.summarise(periods.day_numbers(data.index), data['Rainfall_mm'], TREND_FREQS)
+
+def fit_trends(series):
+    """Trend atlas rows {STAID: {SLOPE_<freq>_<summ>: ..., PVALUE_<freq>_<summ>: ...}} of the
+    {STAID: trend_series} series, fitted per freq in batches of about TREND_CELLS values"""
+    atlas = {stnid: {} for stnid in series}
+    for freq in TREND_FREQS:
+        batch, width = [], 0
+        for stnid, frames in series.items():
+            x = ndates(frames[freq].index)
+            width = max(width, len(x))
+            if batch and width*(len(batch)+1) > TREND_CELLS:
+                _fit_batch(batch, atlas, freq)
+                batch, width = [], len(x)
+            batch.append((stnid, x, frames[freq]))
+        if batch:
+            _fit_batch(batch, atlas, freq)
+    return atlas
+
+def _fit_stations(stnids):
+    """fit_trends of the stations stnids that can be read, run in write_trend_atlas' process pool"""
+    series = {}
+    for stnid in stnids:
+        try:
+            series[stnid] = trend_series(daily_store.read(stnid).set_index('Date'))
+        except Exception as e:
+            print("Error in trend atlas:", stnid, e, file=sys.stderr)
+    return fit_trends(series)
+
+def _fit_batch(batch, atlas, freq):
+    """Fit the (staid, x, TOTAL/MAX frame) series of batch with one ols_trend call per summ, padded with NaN to a matrix"""
+    width = max(len(x) for _, x, _ in batch)
+    X = np.zeros((len(batch), width))
+    for i, (stnid, x, data) in enumerate(batch):
+        X[i, :len(x)] = x
+    for summ, col in SUMMCOLS.items():
+        Y = np.full((len(batch), width), np.nan)
+        for i, (stnid, x, data) in enumerate(batch):
+            Y[i, :len(x)] = data[col].to_numpy()
+        slope, intercept, pval = ols_trend(X, Y)
+        for i, (stnid, x, data) in enumerate(batch):
+            atlas[stnid]['SLOPE_{}_{}'.format(freq, col)] = slope[i]
+            atlas[stnid]['PVALUE_{}_{}'.format(freq, col)] = pval[i]
+
+def trend_columns():
+    """the columns of the trend atlas besides STAID"""
+    return ['{}_{}_{}'.format(kind, freq, col) for freq in TREND_FREQS for col in SUMMCOLS.values()
+            for kind in ('SLOPE', 'PVALUE')]
+
+def write_trend_atlas(stnids=None, fitted=None, refit=False, workers=INGEST_WORKERS):
+    """Slope (per day, as linear_fit) and p-value of the whole series of every station of stnids (all
+    stations if None) for each of TREND_FREQS and SUMMCOLS, written to trend_store.
+    fitted holds the atlas rows of stations just fitted (see ingest_station). The other stations keep
+    their rows of the current atlas unless refit; those without one are read and fitted across a
+    process pool of `workers`, TREND_STATIONS per task. Stations not in stnids are left out."""
+    if stnids is None:
+        stnids = pd.read_feather(station_store, columns=['STAID'])['STAID']
+    stnids = list(stnids)
+    rows = [pd.DataFrame.from_dict(fitted, orient='index')] if fitted else []
+    old = None if refit else trends()
+    if old is not None and set(trend_columns()) <= set(old.columns):
+        old = old.set_index('STAID')
+        rows.append(old[old.index.isin(stnids) & ~old.index.isin(list(fitted or ()))])
+    done = set().union(*(r.index for r in rows))
+    todo = [stnid for stnid in stnids if stnid not in done]
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tasks = [todo[i:i+TREND_STATIONS] for i in range(0, len(todo), TREND_STATIONS)]
+            rows += [pd.DataFrame.from_dict(part, orient='index') for part in pool.map(_fit_stations, tasks)]
+    df = pd.concat([r for r in rows if len(r)]) if any(len(r) for r in rows) else pd.DataFrame()
+    df = df.reindex(index=stnids, columns=trend_columns())
+    df.index.name = 'STAID'
+    write_versioned(df.reset_index(), trend_store, RULES_VERSION)
+
+def trends():
+    """The trend atlas written by write_trend_atlas, None if there is none of RULES_VERSION"""
+    try:
+        if file_version(trend_store) != RULES_VERSION:
+            return None
+        return pd.read_feather(trend_store)
+    except FileNotFoundError:
+        return None
 
 def format_stations(stfile="./data/eca_blend_rr/stations.txt"):
+    import pycountry
     def dms2dd(v):
         v=[float(x.strip()) for x in v.split(':')]
         return v[0]+v[1]/60.+v[2]/3600.
@@ -125,6 +521,7 @@ def format_stations(stfile="./data/eca_blend_rr/stations.txt"):
     stationsdf.dropna(axis=0,  inplace=True)
     stationsdf['STAID']=stationsdf['STAID'].apply('RR_STAID{0:06d}'.format, 8)
     stationsdf['TXT']=stationsdf['STANAME']+" ("+stationsdf['CN']+")"
+    stationsdf['COUNTRY']=stationsdf['CN'].map(country_names(stationsdf['CN']))
     
     #with  pd.to_fea(station_store,"w") as hdfstore:
     #    hdfstore.put('stations',stationsdf, **COMP)
@@ -173,50 +570,74 @@ def stations():
     data = pd.read_feather(station_store)    
     return data
 
-def add_stats_to_stations():
-    """Calculate missing data % and legnth of each series and append to stations df"""
+def add_stats_to_stations(stats=None):
+    """Append missing data %, length and extent (see series_extent) of each series to stations df.
+    stats maps STAID to a dict with LENGTH, MISSING and the extent columns, as returned by
+    rainfallcsv2feather; if not given they are computed from the feather files, as are the extents
+    missing from entries of older manifests (the entries are updated). Stations without stats are removed."""
     stns = pd.read_feather(station_store)
-    #ct=0
-    stns['LENGTH']=np.nan
-    stns['MISSING']=np.nan
-    try:
-        for index, s in stns.iterrows():
-            stnid=s['STAID']
-            FILE='./data/eca_blend_rr/{}.txt'.format(stnid)
-            df=read_rain_from_csv(FILE)
-            missing=df['Rainfall_mm'].isnull().sum()/df['Rainfall_mm'].shape[0]
-            print(FILE, missing)
-            length=df['Rainfall_mm'].shape[0]/360.  # convert to years.
-            stns.iloc[index, stns.columns.get_loc('LENGTH')] = length
-            stns.iloc[index, stns.columns.get_loc('MISSING')] = missing
-            stns.iloc[index, stns.columns.get_loc('TXT')] = s['TXT'] +  ' ({:.0f}y with m={:.3%})'.format(length, missing)
-            #ct+=1
-    except Exception as e:
-        print("Error in add_stats_to_stations stations:", e)
-        print("I assume this is for testing. I will remove the rest of the station entries and continue.")
-        input("Press Enter to continue...")
-        stns.dropna(axis=0, inplace=True)
-    stns.to_feather(station_store) 
+    if stats is None:
+        stats = {stnid: {} for stnid in stns['STAID']}
+    for stnid in stns['STAID']:
+        entry = stats.get(stnid)
+        if entry is None: # not ingested
+            continue
+        nostats, noextent = pd.isna(entry.get('LENGTH', np.nan)), pd.isna(entry.get('FIRST', pd.NaT))
+        if not (nostats or noextent):
+            continue
+        try:
+            df = station_files.read(stnid)
+            if nostats:
+                entry['LENGTH'], entry['MISSING'] = series_stats(df)
+            entry.update(series_extent(df))
+        except Exception as e:
+            print("Error in add_stats_to_stations:", stnid, e, file=sys.stderr)
+    for col in ('LENGTH', 'MISSING', 'FIRST', 'LAST', 'COMPLETE'):
+        stns[col]=stns['STAID'].map(lambda x: stats[x].get(col) if x in stats else None)
+    stns['FIRST'], stns['LAST'] = pd.to_datetime(stns['FIRST']), pd.to_datetime(stns['LAST'])
+    stns.dropna(axis=0, subset=['LENGTH', 'MISSING'], inplace=True)
+    stns['TXT'] = stns['TXT'] + [' ({:.0f}y with m={:.3%})'.format(l, m) for l, m in zip(stns['LENGTH'], stns['MISSING'])]
+    stns.reset_index(drop=True).to_feather(station_store) 
 
-def pre_process():
+def pre_process(workers=INGEST_WORKERS, incremental=False):
+    """Build the feather store from ./data/eca_blend_rr. Each station file is parsed once, in parallel.
+    With incremental=True only station files that are new or changed since the last run (according to
+    the manifest) are parsed, and stations that disappeared are removed.
+    Returns {STAID: error} for station files that could not be ingested."""
     try:
         format_stations()
     except Exception as e:
-        print("Error in formatting stations:", e)
-        input("Press Enter to continue...")
+        print("Error in formatting stations:", e, file=sys.stderr)
+        return {}
+
+    stnids = pd.read_feather(station_store, columns=['STAID'])['STAID']
+    manifest = read_manifest() if incremental else {}
+    if incremental:
+        todo, stats = changed_stations(stnids, manifest)
+        for stnid in set(manifest) - set(stnids):
+            remove_station(stnid)
+        print("{} of {} station files new or changed".format(len(todo), len(stnids)), file=sys.stderr)
+    else:
+        todo, stats = list(stnids), {}
+    new, errors, fits = rainfallcsv2feather(workers, todo) # also writes the aggregate tier and fits trends
+    stats.update(new)
+    add_stats_to_stations(stats)
+    write_manifest(stats)
+    if DAILY_STORE == 'arrow':
+        daily_store.consolidate(station_files, sorted(stats), sorted(new) if incremental else None)
+    write_trend_atlas(fitted=fits, workers=workers) # refits only the stations just ingested
+    write_daily_matrix(sorted(new) if incremental else None)
+    if errors:
+        print("{} station files could not be ingested:".format(len(errors)), file=sys.stderr)
+        for stnid, e in errors.items():
+            print("  ", stnid, e, file=sys.stderr)
+    return errors
 
-    try:
-        rainfallcsv2feather() 
-    except Exception as e:
-        print("Error in rainfallcsv2feather stations:", e)
-        input("Press Enter to continue...")
-    try:
-        add_stats_to_stations()
-    except Exception as e:
-        print("Error in add_stats_to_stations stations:", e)
-        input("Press Enter to continue...")
 if __name__ == "__main__":
-    pre_process() # takes several minutes (10min?) 
+    if '--trends' in sys.argv:
+        write_trend_atlas(refit=True) # only (re)build the trend atlas of an existing store
+        sys.exit()
+    pre_process(incremental='--incremental' in sys.argv) # a full run takes several minutes on one core, scales with INGEST_WORKERS
     freq="ME"
     staid = 'RR_STAID000004'
     ds = resampled(staid, freq, summ=TOTAL)
@@ -0,0 +1,64 @@
+"""Regional series: many stations' daily rainfall (a stations x days matrix on a shared
+calendar, see store.DailyMatrix) summarised per freq bucket and averaged in one pass.
+
+Each station's bucket TOTAL or MAX follows rainproc.resample_data (NaN where the
+bucket has too few valid days, see periods.py); the regional value of a bucket is
+the weighted mean of the stations that have one.
+"""
+import numpy as np
+
+import periods
+
+GRID_CELL = 1.0 # degrees; stations sharing a cell share its weight in the area average
+
+
+def buckets(first, ndays, freq):
+    """(labels, columns, starts, days) of the freq buckets of the ndays days from first: the columns
+    of the days in any bucket (not all of them for single seasons), where in those each bucket
+    starts, and the number of calendar days of each bucket"""
+    code, inside = periods.codes(periods.day_numbers(first)+np.arange(ndays), freq)
+    columns = np.flatnonzero(inside)
+    code = code[columns]
+    starts = np.flatnonzero(np.r_[True, code[1:] != code[:-1]]) if len(code) else columns
+    begin, end = periods.bounds(code[starts], freq)
+    return periods.labels(code[starts], freq), columns, starts, end-begin
+
+def station_buckets(X, starts, summ, minvalid):
+    """Bucket 'TOTAL' or 'MAX' of each row of the daily matrix X (columns of buckets starting at starts),
+    NaN unless more than minvalid (per bucket) days are valid"""
+    valid = ~np.isnan(X)
+    count = np.add.reduceat(valid, starts, axis=1, dtype=np.int32)
+    if summ == 'TOTAL':
+        value = np.add.reduceat(np.where(valid, X, 0), starts, axis=1, dtype=np.float64)
+    else:
+        value = np.fmax.reduceat(X, starts, axis=1).astype(np.float64)
+    return np.where(count > minvalid, value, np.nan)
+
+def station_weights(lon, lat, weighting='mean'):
+    """'mean': every station counts the same. 'area': each GRID_CELL cell with stations counts
+    by its area (cos(lat)), shared equally by its stations, so dense networks do not dominate."""
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    if weighting == 'mean':
+        return np.ones(len(lon))
+    cells = np.floor(lon/GRID_CELL)*1000+np.floor(lat/GRID_CELL)
+    _, inverse, counts = np.unique(cells, return_inverse=True, return_counts=True)
+    return np.cos(np.radians(lat))/counts[inverse]
+
+
+class RegionalMean:
+    """Weighted mean over stations per bucket, accumulated from chunks of station_buckets rows"""
+    def __init__(self, nbuckets):
+        self.num = np.zeros(nbuckets)
+        self.den = np.zeros(nbuckets)
+        self.stations = np.zeros(nbuckets, dtype=int)
+
+    def add(self, values, weights):
+        valid = ~np.isnan(values)
+        self.num += (np.where(valid, values, 0)*weights[:, None]).sum(axis=0)
+        self.den += (valid*weights[:, None]).sum(axis=0)
+        self.stations += valid.sum(axis=0)
+
+    def result(self):
+        """(mean, number of stations averaged) per bucket; the mean is NaN without stations"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.den > 0, self.num/self.den, np.nan), self.stations
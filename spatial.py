@@ -0,0 +1,58 @@
+"""Spatial index of the stations, built from the LON/LAT columns of stations.feather.
+
+Nearest neighbours come from a k-d tree of the stations as points on the unit
+sphere: the chord between two points grows with their great-circle distance, so
+the k nearest by chord are the k nearest by the haversine distance. Bounding
+boxes are a binary search in the stations sorted by latitude. The tree (and scipy)
+is only loaded on the first nearest neighbour query.
+"""
+import threading
+
+import numpy as np
+
+EARTH_RADIUS = 6371.0 # km
+
+
+def _unit(lon, lat):
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+
+class StationIndex:
+    def __init__(self, df):
+        self.lon = df['LON'].to_numpy(dtype=float)
+        self.lat = df['LAT'].to_numpy(dtype=float)
+        self._tree = None
+        self._lock = threading.Lock()
+        self.bylat = np.argsort(self.lat, kind='stable')
+        self.sortedlat = self.lat[self.bylat]
+
+    @property
+    def tree(self):
+        with self._lock:
+            if self._tree is None:
+                from scipy.spatial import cKDTree
+                self._tree = cKDTree(_unit(self.lon, self.lat))
+            return self._tree
+
+    def nearest(self, lon, lat, k=3):
+        """(rows, distances in km) of the k stations nearest to (lon, lat), nearest first"""
+        k = min(k, len(self.lon))
+        chord, rows = self.tree.query(_unit(lon, lat)[0], k=k)
+        rows, chord = np.atleast_1d(rows), np.atleast_1d(chord)
+        return rows, 2*EARTH_RADIUS*np.arcsin(np.minimum(chord/2, 1))
+
+    def neighbours(self, row, k=2):
+        """rows of the k stations nearest to the station row (not itself), nearest first"""
+        rows, _ = self.nearest(self.lon[row], self.lat[row], k+1)
+        return [r for r in rows.tolist() if r != row][:k]
+
+    def within(self, bounds):
+        """rows of the stations in bounds=(west, south, east, north), sorted; west > east spans the antimeridian"""
+        west, south, east, north = bounds
+        i0 = np.searchsorted(self.sortedlat, south, side='left')
+        i1 = np.searchsorted(self.sortedlat, north, side='right')
+        rows = self.bylat[i0:i1]
+        lon = self.lon[rows]
+        inside = (lon >= west) & (lon <= east) if west <= east else (lon >= west) | (lon <= east)
+        return np.sort(rows[inside])
@@ -0,0 +1,69 @@
+"""Zoom dependent station markers for the map.
+
+Up to CLUSTER_MAXZOOM the stations are merged into grid cells of roughly
+1/CELLS_PER_TILE of a map tile; these levels are precomputed at startup. Beyond
+it the individual stations are returned. Either way only markers inside the
+viewport (plus a margin) are sent. Extra columns (e.g. trend classes) are
+averaged over the stations of a cluster.
+"""
+import numpy as np
+import pandas as pd
+
+CLUSTER_MAXZOOM = 6
+CELLS_PER_TILE = 4
+
+
+class StationClusters:
+    def __init__(self, df, maxzoom=CLUSTER_MAXZOOM, cells_per_tile=CELLS_PER_TILE, extra=()):
+        self.maxzoom = maxzoom
+        self.cells_per_tile = cells_per_tile
+        self.extra = list(extra)
+        self.stations = pd.DataFrame({
+            'LON': df['LON'].to_numpy(), 'LAT': df['LAT'].to_numpy(),
+            'COUNT': 1, 'LENGTH': df['LENGTH'].to_numpy(), 'MISSING': df['MISSING'].to_numpy(),
+            'STAID': df['STAID'].to_numpy(), 'TXT': df['TXT'].to_numpy(),
+            **{col: df[col].to_numpy() for col in self.extra}})
+        self.levels = [self._grid(zoom) for zoom in range(maxzoom+1)]
+
+    def cell_size(self, zoom):
+        """grid cell edge in degrees at zoom"""
+        return 360./2**zoom/self.cells_per_tile
+
+    def _grid(self, zoom):
+        st = self.stations
+        cell = self.cell_size(zoom)
+        g = st.groupby([np.floor(st['LON']/cell), np.floor(st['LAT']/cell)], sort=False)
+        agg = g.agg(LON=('LON', 'mean'), LAT=('LAT', 'mean'), COUNT=('COUNT', 'size'),
+                    LENGTH=('LENGTH', 'max'), MISSING=('MISSING', 'mean'),
+                    STAID=('STAID', 'first'), TXT=('TXT', 'first'),
+                    **{col: (col, 'mean') for col in self.extra}).reset_index(drop=True)
+        many = agg['COUNT'] > 1
+        agg.loc[many, 'STAID'] = '' # a click on a cluster selects nothing
+        agg.loc[many, 'TXT'] = ['{} stations (mean m={:.2%}), zoom in for details'.format(n, m)
+                                for n, m in zip(agg.loc[many, 'COUNT'], agg.loc[many, 'MISSING'])]
+        return agg
+
+    def view(self, zoom, bounds=None):
+        """Markers for zoom within bounds=(west, south, east, north), as a DataFrame with
+        LON, LAT, COUNT, LENGTH, MISSING, STAID, TXT and the extra columns (COUNT > 1 for clusters)"""
+        zoom = max(int(zoom), 0)
+        markers = self.levels[zoom] if zoom <= self.maxzoom else self.stations
+        if bounds is None:
+            return markers
+        west, south, east, north = bounds
+        margin = self.cell_size(min(zoom, self.maxzoom))
+        lon, lat = markers['LON'].to_numpy(), markers['LAT'].to_numpy()
+        inside = (lon >= west-margin) & (lon <= east+margin) & (lat >= south-margin) & (lat <= north+margin)
+        return markers[inside]
+
+
+def viewport(relayoutData, zoom=4):
+    """(zoom, bounds) from the relayoutData of a mapbox graph; bounds is None if unknown"""
+    if not relayoutData:
+        return zoom, None
+    zoom = relayoutData.get('mapbox.zoom', zoom)
+    corners = relayoutData.get('mapbox._derived', {}).get('coordinates')
+    if not corners:
+        return zoom, None
+    lons, lats = zip(*corners)
+    return zoom, (min(lons), min(lats), max(lons), max(lats))
@@ -0,0 +1,278 @@
+"""Storage layouts for the daily rainfall series (Date, Rainfall_mm) of the stations.
+
+FeatherStore keeps one feather file per station, as written by ingestion, in
+record batches of about ten years whose first dates are in the schema metadata,
+so a read of a date range only decodes the batches it overlaps.
+ArrowStore packs all stations into one Arrow IPC file that is memory-mapped, with
+a STAID -> row range index in its schema metadata, so a read is a slice of the
+mapped columns instead of opening and decoding a file. Forked workers share the
+mapped pages.
+
+read(staid, start, stop) returns the rows with start <= Date < stop (either may be None).
+
+write_versioned and file_version tag other feather files (aggregates, the trend atlas)
+with the version of the rules they were computed by.
+
+DailyMatrix aligns all stations on one calendar, as a memory-mapped stations x
+days array, for computations over many stations at once (see regional.py).
+"""
+import glob
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather
+
+from cache import file_stamp
+
+
+def _date_range(df, start, stop):
+    """rows of df (sorted by Date) with start <= Date < stop"""
+    dates = df['Date'].to_numpy()
+    i0 = np.searchsorted(dates, np.datetime64(start, 'ns')) if start is not None else 0
+    i1 = np.searchsorted(dates, np.datetime64(stop, 'ns')) if stop is not None else len(dates)
+    return df.iloc[i0:i1].reset_index(drop=True)
+
+VERSION_KEY = b'version'
+
+def write_versioned(df, path, version):
+    """Write df (without its index) as a feather file with version in its schema metadata"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), VERSION_KEY: str(version)})
+    pa.feather.write_feather(table, path)
+
+def file_version(path):
+    """the version write_versioned wrote into a feather file (None if none), read without its columns"""
+    metadata = pa.ipc.open_file(pa.memory_map(path)).schema.metadata or {}
+    version = metadata.get(VERSION_KEY)
+    return None if version is None else version.decode()
+
+
+class FeatherStore:
+    BATCH_KEY = b'batch_starts'
+    BATCH_ROWS = 3653 # days in a record batch
+
+    def __init__(self, pattern):
+        self.pattern = pattern # e.g. './data/feather/STN{}'
+
+    def path(self, staid):
+        return self.pattern.format(staid)
+
+    def read(self, staid, start=None, stop=None):
+        if start is None and stop is None:
+            return pd.read_feather(self.path(staid))
+        reader = pa.ipc.open_file(pa.memory_map(self.path(staid)))
+        starts = (reader.schema.metadata or {}).get(self.BATCH_KEY)
+        if starts is None: # written without the batch index
+            return _date_range(pd.read_feather(self.path(staid)), start, stop)
+        starts = np.array(json.loads(starts), dtype='datetime64[ns]')
+        b0 = max(np.searchsorted(starts, np.datetime64(start, 'ns'), side='right')-1, 0) if start is not None else 0
+        b1 = np.searchsorted(starts, np.datetime64(stop, 'ns')) if stop is not None else len(starts)
+        table = pa.Table.from_batches([reader.get_batch(i) for i in range(b0, b1)], schema=reader.schema)
+        return _date_range(table.to_pandas(), start, stop)
+
+    def write(self, staid, df):
+        """Write df (sorted by Date) as a feather file of BATCH_ROWS record batches, indexed by their first dates"""
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        batches = table.to_batches(max_chunksize=self.BATCH_ROWS)
+        starts = [int(b.column('Date')[0].value) for b in batches]
+        schema = table.schema.with_metadata({**table.schema.metadata, self.BATCH_KEY: json.dumps(starts)})
+        options = pa.ipc.IpcWriteOptions(compression='lz4')
+        with pa.OSFile(self.path(staid), 'wb') as sink:
+            with pa.ipc.new_file(sink, schema, options=options) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+
+    def stamp(self, staid):
+        return file_stamp(self.path(staid))
+
+    def remove(self, staid):
+        try:
+            os.remove(self.path(staid))
+        except FileNotFoundError:
+            pass
+
+
+class ArrowStore:
+    INDEX_KEY = b'staid_index'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._opened = None # (stamp, dates, rain, index)
+
+    def _open(self):
+        stamp = file_stamp(self.path)
+        with self._lock:
+            if self._opened is None or self._opened[0] != stamp:
+                if stamp is None:
+                    raise FileNotFoundError(self.path)
+                table = pa.ipc.open_file(pa.memory_map(self.path)).read_all()
+                index = json.loads(table.schema.metadata[self.INDEX_KEY])
+                # single chunk columns without nulls, so these are views of the mapped file
+                dates = table.column('Date').chunk(0).to_numpy(zero_copy_only=True)
+                rain = table.column('Rainfall_mm').chunk(0).to_numpy(zero_copy_only=True)
+                self._opened = (stamp, dates, rain, index)
+            return self._opened
+
+    def read(self, staid, start=None, stop=None):
+        _, dates, rain, index = self._open()
+        try:
+            i0, i1 = index[staid]
+        except KeyError:
+            raise FileNotFoundError('{} not in {}'.format(staid, self.path)) from None
+        if start is not None:
+            i0 += np.searchsorted(dates[i0:i1], np.datetime64(start, 'ns'))
+        if stop is not None:
+            i1 = i0+np.searchsorted(dates[i0:i1], np.datetime64(stop, 'ns'))
+        return pd.DataFrame({'Date': dates[i0:i1], 'Rainfall_mm': rain[i0:i1]})
+
+    def stamp(self, staid):
+        return file_stamp(self.path)
+
+    def staids(self):
+        return list(self._open()[3])
+
+    def consolidate(self, source, stnids, changed=None):
+        """(Re)write the file from the stations stnids of another store. Replaces the file atomically.
+        Given the stations whose data changed, a file of the same stations is left alone if there are none."""
+        if changed is not None and not len(changed):
+            try:
+                if self.staids() == list(stnids):
+                    return
+            except FileNotFoundError:
+                pass
+        index, dates, rain, n = {}, [], [], 0
+        for staid in stnids:
+            df = source.read(staid)
+            index[staid] = (n, n+len(df))
+            n += len(df)
+            dates.append(df['Date'].to_numpy(dtype='datetime64[ns]'))
+            rain.append(df['Rainfall_mm'].to_numpy(dtype=float))
+        batch = pa.record_batch([
+            pa.array(np.concatenate(dates) if dates else np.array([], dtype='datetime64[ns]')),
+            pa.array(np.concatenate(rain) if rain else np.array([], dtype=float), from_pandas=False), # keep NaN, not null
+        ], schema=pa.schema([('Date', pa.timestamp('ns')), ('Rainfall_mm', pa.float64())],
+                            metadata={self.INDEX_KEY: json.dumps(index)}))
+        tmp = '{}.tmp{}'.format(self.path, os.getpid())
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, batch.schema) as writer:
+                writer.write_batch(batch)
+        os.replace(tmp, self.path)
+
+
+class DailyMatrix:
+    """Daily rainfall of all stations on a shared calendar: a float32 stations x days .npy file
+    (NaN = missing), memory-mapped. Its index path+'.json' holds the STAID of each row, the first day
+    and the name of the .npy (path with a token added). A rebuild writes a new .npy before it
+    replaces the index, so readers, who only follow the index, always get a matching pair."""
+    def __init__(self, path):
+        self.path = path
+        self.index = path+'.json'
+        self._lock = threading.Lock()
+        self._opened = None # (stamp, matrix, first day, rows)
+
+    def _meta(self):
+        """the index, None if there is none (or it is of a version without tokens)"""
+        try:
+            with open(self.index) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        return meta if 'data' in meta else None
+
+    def _data(self, meta):
+        return os.path.join(os.path.dirname(self.path), meta['data'])
+
+    def _open(self):
+        stamp = self.stamp()
+        with self._lock:
+            if self._opened is None or self._opened[0] != stamp:
+                meta = self._meta() if stamp else None
+                if meta is None:
+                    raise FileNotFoundError(self.path)
+                matrix = np.load(self._data(meta), mmap_mode='r')
+                if list(matrix.shape) != meta['shape']:
+                    raise OSError('{} does not match {}'.format(meta['data'], self.index))
+                rows = {staid: i for i, staid in enumerate(meta['staids'])}
+                self._opened = (stamp, matrix, np.datetime64(meta['first'], 'D'), rows)
+            return self._opened
+
+    def stamp(self):
+        """changes whenever the matrix does"""
+        return file_stamp(self.index)
+
+    def window(self, start=None, stop=None):
+        """(first day, number of days) of the calendar from start to stop (exclusive), within the matrix"""
+        _, matrix, first, _ = self._open()
+        c0, c1 = self._columns(matrix, first, start, stop)
+        return first+c0, c1-c0
+
+    @staticmethod
+    def _columns(matrix, first, start, stop):
+        ndays = matrix.shape[1]
+        c0 = 0 if start is None else int(np.clip((np.datetime64(start, 'D')-first).astype(int), 0, ndays))
+        c1 = ndays if stop is None else int(np.clip((np.datetime64(stop, 'D')-first).astype(int), c0, ndays))
+        return c0, c1
+
+    def read(self, staids, start=None, stop=None):
+        """the days from start to stop (see window) of the stations staids, as a float32 array"""
+        _, matrix, first, rows = self._open()
+        try:
+            idx = [rows[staid] for staid in staids]
+        except KeyError as e:
+            raise FileNotFoundError('{} not in {}'.format(e.args[0], self.path)) from None
+        c0, c1 = self._columns(matrix, first, start, stop)
+        return matrix[idx, c0:c1]
+
+    @staticmethod
+    def _row(source, staid, first, ndays):
+        df = source.read(staid)
+        cols = (df['Date'].to_numpy(dtype='datetime64[D]')-first).astype(int)
+        row = np.full(ndays, np.nan, dtype=np.float32)
+        row[cols] = df['Rainfall_mm'].to_numpy()
+        return row
+
+    def _write_meta(self, meta):
+        tmp = '{}.tmp{}'.format(self.index, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.index)
+
+    def build(self, source, stnids, first, last, changed=None):
+        """(Re)write the matrix of the days first to last from the stations stnids of another store.
+        Given the stations whose data changed, a matrix of the same stations and days only has their
+        rows rewritten in place (readers may see a row half rewritten meanwhile), or is left alone if
+        there are none. Otherwise all rows are written to a new .npy and the index switched to it."""
+        first = np.datetime64(first, 'D')
+        ndays = int((np.datetime64(last, 'D')-first).astype(int))+1
+        meta = dict(first=str(first), shape=[len(stnids), ndays], staids=list(stnids))
+        old = self._meta()
+        same = old is not None and all(old[k] == meta[k] for k in meta) and os.path.exists(self._data(old))
+        if changed is not None and same:
+            if not len(changed):
+                return
+            rows = {staid: i for i, staid in enumerate(stnids)}
+            matrix = np.load(self._data(old), mmap_mode='r+')
+            for staid in changed:
+                if staid in rows:
+                    matrix[rows[staid]] = self._row(source, staid, first, ndays)
+            matrix.flush()
+            del matrix
+            self._write_meta(dict(old, revision=os.urandom(8).hex())) # a new stamp
+            return
+        base = os.path.splitext(self.path)[0]
+        meta['data'] = os.path.basename('{}.{}.npy'.format(base, os.urandom(8).hex()))
+        matrix = np.lib.format.open_memmap(self._data(meta), mode='w+', dtype=np.float32, shape=(len(stnids), ndays))
+        for i, staid in enumerate(stnids):
+            matrix[i] = self._row(source, staid, first, ndays)
+        matrix.flush()
+        del matrix
+        self._write_meta(meta)
+        # older versions (and the untokened file of before); open mappings of them stay valid
+        for path in glob.glob(glob.escape(base)+'.*.npy')+[self.path]:
+            if path != self._data(meta) and os.path.exists(path):
+                os.remove(path)
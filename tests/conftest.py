@@ -0,0 +1,5 @@
+import os
+import sys
+
+os.environ.setdefault('RAINFALL_CACHE_DIR', '') # no disk cache under the working directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
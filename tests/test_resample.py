@@ -0,0 +1,92 @@
+"""rainproc.resample_data against a frozen copy of the first, per-bucket lambda, resampler."""
+import numpy as np
+import pandas as pd
+import pytest
+
+import periods
+import rainproc as rp
+
+# freq: (pandas resample freq, pandas period freq, months of a window at the end of the period or None)
+LEGACY_FREQS = {
+    'YE': ('YE', 'Y', None), 'ME': ('ME', 'M', None), 'QE': ('QE', 'Q', None), 'WE': ('W-SUN', 'W-SUN', None),
+    '24H': ('24h', 'D', None),
+    'HYE': ('YE-SEP', 'Y-SEP', None), 'SEASON': ('QE-FEB', 'Q-FEB', None),
+    'DJF': ('YE-FEB', 'Y-FEB', 3), 'JJA': ('YE-AUG', 'Y-AUG', 3), 'M5-9': ('YE-SEP', 'Y-SEP', 5),
+}
+CALENDAR_FREQS = ['YE', 'ME', 'QE', 'WE', '24H']
+
+
+def notmissingthres(x, freq):
+    """valid days the bucket of the rows x needs more than: COMPLETE of its calendar days"""
+    if freq == '24H':
+        return periods.COMPLETE
+    _, period, months = LEGACY_FREQS[freq]
+    bucket = pd.Period(x.index[0], period)
+    end = bucket.end_time.normalize()
+    start = bucket.start_time if months is None else end-pd.DateOffset(months=months)+pd.Timedelta(days=1)
+    return periods.COMPLETE*((end-start).days+1)
+
+def in_window(data, freq):
+    """the rows of data in the months of the windows of freq (all for the other period types)"""
+    _, period, months = LEGACY_FREQS[freq]
+    if months is None:
+        return data
+    last = pd.Period('2001-01', period).end_time.month
+    return data[(last-data.index.month) % 12 < months]
+
+def legacy_resampled(data, freq, summ):
+    if summ==rp.TOTAL:
+        return data.resample(LEGACY_FREQS[freq][0]).apply(lambda x:
+                                 x.sum(skipna=True) if len(x) and x.notnull().sum() > notmissingthres(x, freq)
+                                 else np.nan)
+    if summ==rp.MAX:
+        return data.resample(LEGACY_FREQS[freq][0]).apply(lambda x:
+                                         x.max(skipna=True) if len(x) and x.notnull().sum() > notmissingthres(x, freq)
+                                     else np.nan)
+
+def daily(start, end, seed=0, missing=.05, gaps=3):
+    """Date-indexed Rainfall_mm from start to end with scattered NaN and `gaps` runs of absent rows"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, end, freq='D', name='Date')
+    rain = np.where(rng.random(len(dates)) < .6, 0, rng.gamma(.8, 6, len(dates))).round(1)
+    rain[rng.random(len(dates)) < missing] = np.nan
+    keep = np.ones(len(dates), dtype=bool)
+    for s in rng.integers(0, len(dates)-40, gaps):
+        keep[s:s+rng.integers(5, 40)] = False
+    return pd.DataFrame({'Rainfall_mm': rain[keep]}, index=dates[keep])
+
+SERIES = [
+    daily('1895-03-17', '1905-08-02', seed=1), # 1900 is not a leap year
+    daily('1994-12-30', '2004-01-03', seed=2, missing=.02), # 1996, 2000 and 2004 are
+    daily('2010-01-01', '2012-12-31', seed=3, missing=.3, gaps=10),
+]
+
+
+@pytest.mark.parametrize('freq', CALENDAR_FREQS)
+@pytest.mark.parametrize('summ', [rp.TOTAL, rp.MAX])
+@pytest.mark.parametrize('series', range(len(SERIES)))
+def test_matches_legacy(series, summ, freq):
+    data = SERIES[series]
+    expected = legacy_resampled(data, freq, summ)
+    pd.testing.assert_frame_equal(rp.resample_data(data, freq, summ), expected, check_freq=False)
+
+@pytest.mark.parametrize('freq', [freq for freq in LEGACY_FREQS if freq not in CALENDAR_FREQS])
+@pytest.mark.parametrize('summ', [rp.TOTAL, rp.MAX])
+@pytest.mark.parametrize('series', range(len(SERIES)))
+def test_seasons_match_legacy(series, summ, freq):
+    """hydrological years, seasons and windows of months: the legacy resampler over the days in them"""
+    data = SERIES[series]
+    expected = legacy_resampled(in_window(data, freq), freq, summ)
+    pd.testing.assert_frame_equal(rp.resample_data(data, freq, summ), expected, check_freq=False)
+
+def test_leap_february():
+    """26 valid days fill a February of 28 days (more than 25.2) but not one of 29 (26.1)"""
+    dates = pd.date_range('1999-02-01', '2000-02-29', freq='D', name='Date')
+    rain = np.ones(len(dates))
+    rain[(dates.month == 2) & (dates.day > 26)] = np.nan
+    data = rp.resample_data(pd.DataFrame({'Rainfall_mm': rain}, index=dates), 'ME', rp.TOTAL)['Rainfall_mm']
+    assert data['1999-02-28'] == 26
+    assert np.isnan(data['2000-02-29'])
+
+def test_bad_summ():
+    assert rp.resample_data(SERIES[0], 'YE', 3) is None
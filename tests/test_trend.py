@@ -0,0 +1,114 @@
+"""trend.py against direct O(n^2) definitions and scipy."""
+import warnings
+
+import numpy as np
+import pytest
+from scipy import stats
+
+from trend import ols_trend, mann_kendall, sen_slope
+
+
+def brute_mann_kendall(y):
+    """(S, pvalue) of the valid values of y from all pairs, with the tie corrected variance"""
+    y = y[~np.isnan(y)]
+    n = len(y)
+    s = sum(np.sign(y[j]-y[i]) for i in range(n) for j in range(i+1, n))
+    t = np.unique(y, return_counts=True)[1]
+    var = (n*(n-1)*(2*n+5)-(t*(t-1)*(2*t+5)).sum())/18
+    z = (s-np.sign(s))/np.sqrt(var) if var > 0 else 0
+    return s, 2*stats.norm.sf(abs(z))
+
+def brute_sen(x, y):
+    """(median of all pairwise slopes, median of y - slope*x) of the valid values of y"""
+    valid = ~np.isnan(y)
+    x, y = x[valid], y[valid]
+    i, j = np.triu_indices(len(y), 1)
+    slope = np.median((y[j]-y[i])/(x[j]-x[i]))
+    return slope, np.median(y-slope*x)
+
+def first(arrays):
+    """the values of the first row of a result"""
+    return tuple(a[0] for a in arrays)
+
+def series(n, seed, ties=False, missing=0.):
+    rng = np.random.default_rng(seed)
+    y = .02*np.arange(n)+rng.gamma(2, 3, n)
+    if ties:
+        y = y.round() # many equal values
+    y[rng.random(n) < missing] = np.nan
+    return y
+
+CASES = [
+    dict(n=3), dict(n=4), dict(n=6), dict(n=7), # 3, 6, 15 and 21 pairs: odd and even counts
+    dict(n=40, ties=True),
+    dict(n=41, missing=.2),
+    dict(n=120, ties=True, missing=.1),
+    dict(n=500, missing=.05), # more slopes than SEN_EXACT around the median
+    dict(n=700, ties=True),
+]
+
+
+@pytest.mark.parametrize('case', CASES, ids=[str(c) for c in CASES])
+def test_mann_kendall(case):
+    y = series(seed=1, **case)
+    s, p = mann_kendall(y)
+    es, ep = brute_mann_kendall(y)
+    assert s[0] == es
+    assert p[0] == pytest.approx(ep, rel=1e-9)
+
+@pytest.mark.parametrize('case', CASES, ids=[str(c) for c in CASES])
+def test_sen_slope(case):
+    y = series(seed=2, **case)
+    x = np.arange(len(y))*365.25
+    slope, intercept = sen_slope(x, y)
+    eslope, eintercept = brute_sen(x, y)
+    assert slope[0] == pytest.approx(eslope, rel=1e-9, abs=1e-15)
+    assert intercept[0] == pytest.approx(eintercept, rel=1e-9, abs=1e-12)
+    valid = ~np.isnan(y)
+    assert slope[0] == pytest.approx(stats.theilslopes(y[valid], x[valid])[0], rel=1e-9, abs=1e-15)
+
+def test_sen_flat():
+    """a zero median slope among many equal values"""
+    y = np.r_[np.zeros(300), np.ones(3)]
+    slope, intercept = sen_slope(np.arange(len(y)), y)
+    assert slope[0] == 0 and intercept[0] == 0
+
+def test_batched_rows():
+    """rows of different lengths and gaps fitted together as one by one, x per row"""
+    rows = [series(n, seed, ties=seed % 2 == 0, missing=.1) for seed, n in enumerate((5, 60, 300, 2, 33))]
+    width = max(map(len, rows))
+    Y, X = np.full((len(rows), width), np.nan), np.zeros((len(rows), width))
+    for i, y in enumerate(rows):
+        Y[i, :len(y)], X[i, :len(y)] = y, np.arange(len(y))+3*i
+    slope, intercept = sen_slope(X, Y)
+    s, p = mann_kendall(Y)
+    oslope, ointercept, opval = ols_trend(X, Y)
+    for i, y in enumerate(rows):
+        x = X[i, :len(y)]
+        assert (slope[i], intercept[i]) == pytest.approx(first(sen_slope(x, y)), rel=1e-12, nan_ok=True)
+        assert (s[i], p[i]) == pytest.approx(first(mann_kendall(y)), rel=1e-12, nan_ok=True)
+        assert (oslope[i], ointercept[i], opval[i]) == pytest.approx(first(ols_trend(x, y)), rel=1e-9, nan_ok=True)
+
+def test_too_few_values():
+    """rows with fewer than two (three for Mann-Kendall) values give NaN, without warnings"""
+    Y = np.full((4, 6), np.nan)
+    Y[1, 2] = 1.
+    Y[2, [0, 4]] = 1., 3.
+    Y[3] = np.arange(6.)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        slope, intercept = sen_slope(np.arange(6.), Y)
+        s, p = mann_kendall(Y)
+    assert np.isnan(slope[:2]).all() and np.isnan(intercept[:2]).all()
+    assert slope[2] == .5 and intercept[2] == 1
+    assert np.isnan(s[:3]).all() and np.isnan(p[:3]).all()
+    assert s[3] == 15
+
+def test_ols_trend():
+    y = series(200, seed=3, missing=.1)
+    x = np.arange(len(y))
+    valid = ~np.isnan(y)
+    slope, intercept, pvalue = ols_trend(x, y)
+    expected = stats.linregress(x[valid], y[valid])
+    assert (slope[0], intercept[0], pvalue[0]) == pytest.approx(
+        (expected.slope, expected.intercept, expected.pvalue), rel=1e-9)
@@ -0,0 +1,223 @@
+"""Trend estimators that fit many series at once from a stations x time matrix (NaN = missing)."""
+import numpy as np
+
+
+def ols_trend(x, Y):
+    """Least squares line y = intercept + slope*x through every row of Y, ignoring NaNs.
+
+    x is shared by all rows (shape (t,)) or given per row (same shape as Y).
+    Returns (slope, intercept, pvalue) arrays with one value per row; pvalue is the
+    two sided t-test of slope == 0, as statsmodels OLS reports it. Rows with fewer
+    than two valid values get NaN.
+    """
+    from scipy.special import stdtr # deferred, it is a large part of the app's import time
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    x = np.broadcast_to(np.asarray(x, dtype=float), Y.shape)
+    valid = ~np.isnan(Y)
+    n = valid.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xm = np.where(valid, x, 0).sum(axis=1)/n
+        ym = np.where(valid, Y, 0).sum(axis=1)/n
+        dx = np.where(valid, x-xm[:, None], 0)
+        dy = np.where(valid, Y-ym[:, None], 0)
+        sxx = (dx*dx).sum(axis=1)
+        slope = (dx*dy).sum(axis=1)/sxx
+        intercept = ym-slope*xm
+        rss = ((dy-slope[:, None]*dx)**2).sum(axis=1)
+        dof = n-2
+        se = np.sqrt(rss/dof/sxx)
+        pvalue = 2*stdtr(dof, -np.abs(slope/se))
+    pvalue = np.where(dof > 0, pvalue, np.nan)
+    return slope, intercept, pvalue
+
+
+def _compact(Y):
+    """rows of Y with their valid values moved to the front (in order), the number of valid values
+    per row and the width padded to a power of two"""
+    valid = ~np.isnan(Y)
+    n = valid.sum(axis=1)
+    width = 1 << max(int(Y.shape[1]-1).bit_length(), 1)
+    order = np.argsort(~valid, axis=1, kind='stable')
+    Z = np.full((len(Y), width), np.inf)
+    Z[:, :Y.shape[1]] = np.take_along_axis(Y, order, axis=1)
+    Z[np.arange(width) >= n[:, None]] = np.inf
+    return Z, n
+
+def _ranks(Z):
+    """dense rank of every value within its row (equal values share a rank)"""
+    order = np.argsort(Z, axis=1, kind='stable')
+    S = np.take_along_axis(Z, order, axis=1)
+    new = np.ones(S.shape, dtype=bool)
+    new[:, 1:] = S[:, 1:] != S[:, :-1]
+    R = np.empty(S.shape, dtype=np.int64)
+    np.put_along_axis(R, order, np.cumsum(new, axis=1)-1, axis=1)
+    return R, S, new
+
+def _inversions(R, per_value=False):
+    """Number of pairs i < j with R[i] > R[j] in every row of the rank matrix R (width a power
+    of two), by a bottom-up merge sort of all rows at once: at each level a stable argsort
+    merges sorted runs, which it does in linear time, and an element of a right run passes
+    every larger element of the left run it is merged with. With per_value also the number of
+    larger values before and of smaller values after every value (matrices shaped as R)."""
+    rows, width = R.shape
+    s = R.ravel()
+    pos = np.arange(s.size)
+    row = pos//width
+    count = np.zeros(rows, dtype=np.int64)
+    if per_value:
+        orig, larger, smaller = pos, np.zeros(s.size, dtype=np.int64), np.zeros(s.size, dtype=np.int64)
+    w = 1
+    while w < width:
+        blk, right = pos//(2*w), (pos//w) % 2 == 1
+        order = np.argsort(blk*(2*width)+2*s+right, kind='stable') # left before right on ties
+        merged = np.empty_like(pos)
+        merged[order] = pos
+        # an element at index k of its run, merged at p, follows p-blk*2w-k elements of the other run
+        follows = merged-blk*2*w-(pos % w)
+        passed = w-follows
+        count += np.bincount(row[right], passed[right], minlength=rows).astype(np.int64)
+        if per_value:
+            larger[orig[right]] += passed[right]
+            smaller[orig[~right]] += follows[~right]
+            orig = orig[order]
+        s = s[order]
+        w *= 2
+    if per_value:
+        return count, larger.reshape(R.shape), smaller.reshape(R.shape)
+    return count
+
+def mann_kendall(Y):
+    """Mann-Kendall test of a monotonic trend in every row of Y (in time order, NaN = missing).
+
+    Returns (S, pvalue) arrays with one value per row. S is the number of later values above
+    an earlier one minus those below, counted in O(n log n) from the inversions of the row;
+    pvalue is two sided, from the normal approximation with the variance corrected for tied
+    values. Rows with fewer than three valid values get NaN.
+    """
+    from scipy.special import ndtr
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    Z, n = _compact(Y)
+    R, S, new = _ranks(Z)
+    # sizes of the groups of tied values (the padding is one group after the valid values)
+    starts = np.flatnonzero(new.ravel())
+    t = np.diff(np.append(starts, new.size))
+    trow = starts//Z.shape[1]
+    real = np.isfinite(S.ravel()[starts])
+    ties = np.bincount(trow[real], (t*(t-1)//2)[real], minlength=len(Y))
+    tvar = np.bincount(trow[real], (t*(t-1)*(2*t+5))[real], minlength=len(Y))
+    s = n*(n-1)//2-ties-2*_inversions(R)
+    var = (n*(n-1)*(2*n+5)-tvar)/18
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (s-np.sign(s))/np.sqrt(var)
+        pvalue = np.where(var > 0, 2*ndtr(-np.abs(z)), 1.0)
+    return np.where(n >= 3, s, np.nan), np.where(n >= 3, pvalue, np.nan)
+
+def _slopes_below(X, Z, n, t, per_value=False):
+    """number of pairwise slopes below t[i] in every row of the compacted Z and X (see _compact):
+    the inversions of Z-t*X, as _inversions counts them"""
+    D = Z-t[:, None]*X
+    D[np.arange(Z.shape[1]) >= n[:, None]] = np.inf
+    return _inversions(_ranks(D)[0], per_value)
+
+def _kth_slope(X, Z, n, k, lo, hi, below_lo, below_hi, tol):
+    """the k[i]-th smallest pairwise slope of every row, from lo (below_lo < k[i] slopes below
+    it) and hi (below_hi >= k[i] slopes below it).
+
+    The bracket is narrowed (interpolating by the counts of slopes below its ends) until at most
+    SEN_EXACT slopes are left in it, or it is narrower than tol. As t grows pairs only ever become inversions of Z-t*X, so the pairs with a
+    slope in the bracket are those of a value whose count of larger values before it grew with
+    a value whose count of smaller values after it grew: these few are listed and sorted.
+    """
+    active = np.flatnonzero((below_hi-below_lo > SEN_EXACT) & (hi-lo > tol))
+    while len(active):
+        a, b, clo, chi, ka = lo[active], hi[active], below_lo[active], below_hi[active], k[active]
+        # slopes are about evenly spread over a narrow bracket: try t on either side of where
+        # the k-th would be if they were, a few standard deviations of that guess apart
+        margin = 2*np.sqrt(chi-clo)+SEN_EXACT/4
+        for f in ((ka-margin-clo)/(chi-clo), (ka+margin-clo)/(chi-clo)):
+            t = a+(b-a)*np.clip(f, 1/16, 15/16)
+            count = _slopes_below(X[active], Z[active], n[active], t)
+            below = count < ka
+            lo[active[below]], below_lo[active[below]] = t[below], count[below]
+            hi[active[~below]], below_hi[active[~below]] = t[~below], count[~below]
+            a, b, clo, chi = lo[active], hi[active], below_lo[active], below_hi[active]
+        active = active[(below_hi[active]-below_lo[active] > SEN_EXACT) & (hi[active]-lo[active] > tol[active])]
+    _, larger_lo, smaller_lo = _slopes_below(X, Z, n, lo, per_value=True)
+    _, larger_hi, smaller_hi = _slopes_below(X, Z, n, hi, per_value=True)
+    kth = np.full(len(Z), np.nan)
+    for r in np.flatnonzero(n >= 2):
+        first = np.flatnonzero(smaller_hi[r] > smaller_lo[r]) # the earlier value of a pair in the bracket
+        second = np.flatnonzero(larger_hi[r] > larger_lo[r])
+        if below_hi[r]-below_lo[r] > SEN_EXACT:
+            first = first[:1] # narrower than tol: any slope in the bracket will do
+        i, j = (a.ravel() for a in np.meshgrid(first, second))
+        i, j = i[i < j], j[i < j]
+        dlo, dhi = Z[r]-lo[r]*X[r], Z[r]-hi[r]*X[r]
+        inside = (dlo[j] >= dlo[i]) & (dhi[j] < dhi[i])
+        slopes = np.sort((Z[r, j]-Z[r, i])[inside]/(X[r, j]-X[r, i])[inside])
+        kth[r] = slopes[min(k[r]-below_lo[r]-1, len(slopes)-1)]
+    return kth
+
+SEN_SAMPLE = 4 # random pairs per value whose slopes bracket the median
+SEN_EXACT = 256 # slopes left in the bracket when they are listed
+SEN_RTOL = 1e-12 # of the steepest possible slope of a row: bisection stops there if many slopes are equal
+
+def sen_slope(x, Y, seed=0):
+    """Theil-Sen line y = intercept + slope*x through every row of Y, ignoring NaNs.
+
+    x is shared by all rows (shape (t,)) or given per row (same shape as Y), increasing over
+    the valid values of a row. The slope is the median of the slopes
+    between all pairs of valid values, found without listing them all: the number of slopes
+    below t is the number of inversions of y - t*x, counted in O(n log n), so the slopes of
+    randomly sampled pairs bracket the median, bisection narrows the bracket and the few slopes
+    left in it are listed (see _kth_slope). The intercept is the median of y - slope*x.
+    Returns (slope, intercept) arrays with one value per row; rows with fewer than two valid
+    values get NaN.
+    """
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    x = np.asarray(x, dtype=float)
+    Z, n = _compact(Y)
+    X = np.zeros(Z.shape)
+    X[:, :Y.shape[1]] = np.take_along_axis(np.broadcast_to(x, Y.shape), np.argsort(np.isnan(Y), axis=1, kind='stable'), axis=1)
+    inside = np.arange(Z.shape[1]) < n[:, None]
+    # every slope lies within +-bound
+    yrange = np.where(inside, Z, -np.inf).max(axis=1, initial=0)-np.where(inside, Z, np.inf).min(axis=1, initial=0)
+    dx = np.where(inside[:, 1:], np.diff(X, axis=1), np.inf).min(axis=1, initial=np.inf)
+    bound = np.where(n >= 2, yrange/dx, 0)*1.001+1e-300
+    # the median of an even number of slopes is the mean of the two middle ones: rows of the
+    # second one are appended
+    npairs = n*(n-1)//2
+    kl, kh = (npairs+1)//2, npairs//2+1
+    rows = np.concatenate([np.arange(len(Z)), np.flatnonzero((kl != kh) & (n >= 2))])
+    k = np.concatenate([kl, kh[rows[len(Z):]]])
+    Xr, Zr, nr = X[rows], Z[rows], n[rows]
+    # the slopes of SEN_SAMPLE*n random pairs per row: their quantiles around k/npairs
+    rng = np.random.default_rng(seed)
+    m = SEN_SAMPLE*max(int(n.max(initial=0)), 2)
+    last = np.maximum(nr-1, 0)[:, None]
+    i = np.minimum((rng.random((len(rows), m))*nr[:, None]).astype(int), last)
+    j = np.minimum((rng.random((len(rows), m))*nr[:, None]).astype(int), last)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sample = ((np.take_along_axis(Zr, j, 1)-np.take_along_axis(Zr, i, 1))
+                  /(np.take_along_axis(Xr, j, 1)-np.take_along_axis(Xr, i, 1)))
+    sample = np.sort(np.where(np.isfinite(sample), sample, np.inf), axis=1)
+    nsample = np.isfinite(sample).sum(axis=1)
+    q = k/np.maximum(npairs[rows], 1)
+    spread = 3/np.sqrt(m)
+    def quantile(f):
+        at = np.clip((f*nsample).astype(int), 0, np.maximum(nsample-1, 0))
+        value = np.take_along_axis(sample, at[:, None], 1)[:, 0]
+        return np.where(np.isfinite(value), value, 0)
+    # unless they do bracket the k-th slope, the bracket is +-bound
+    lo, hi = quantile(q-spread), quantile(q+spread)
+    below_lo, below_hi = _slopes_below(Xr, Zr, nr, lo), _slopes_below(Xr, Zr, nr, hi)
+    lo, below_lo = np.where(below_lo < k, lo, -bound[rows]), np.where(below_lo < k, below_lo, 0)
+    hi, below_hi = np.where(below_hi >= k, hi, bound[rows]), np.where(below_hi >= k, below_hi, npairs[rows])
+    kth = _kth_slope(Xr, Zr, nr, k, lo, hi, below_lo, below_hi, SEN_RTOL*bound[rows])
+    slope = kth[:len(Z)]
+    slope[rows[len(Z):]] = (slope[rows[len(Z):]]+kth[len(Z):])/2
+    intercept = np.full(len(Z), np.nan)
+    fit = n >= 2 # nanmedian warns about rows without values
+    with np.errstate(invalid='ignore'):
+        intercept[fit] = np.nanmedian(np.where(inside[fit], Z[fit]-slope[fit, None]*X[fit], np.nan), axis=1)
+    return slope, intercept